@@ -1,12 +1,21 @@
 import os
+import sys
 from pathlib import Path
 import argparse
 import configparser
 from types import SimpleNamespace
-from common_pyutil.functional import first_by
 
-from .util import print_
+from .util import print_, warn_, setup_logging
 from .files import Files
+from .fingerprints import BuildInputs
+from .metrics import BuildMetrics, append_history, history_file, load_history, report_stats
+
+
+def add_verbosity_args(parser: argparse.ArgumentParser):
+    parser.add_argument("-q", "--quiet", action="count", default=0,
+                        help="Print only warnings and errors")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Print detailed messages")
 
 
 def check_arguments(args: SimpleNamespace, config: configparser.ConfigParser,
@@ -31,11 +40,11 @@ def check_arguments(args: SimpleNamespace, config: configparser.ConfigParser,
     #     return check_files_data(input_dir, input_dir.joinpath(".files_data"), arg)
 
     def check_vars_file(arg):
-        return str(first_by([Path(arg),
-                             Path(args.input_dir).joinpath(arg),
-                             Path(args.input_dir).joinpath(Path(arg).name)],
-                            Path.exists).absolute()
-                   or "")
+        path = next(filter(Path.exists, [Path(arg),
+                                         Path(args.input_dir).joinpath(arg),
+                                         Path(args.input_dir).joinpath(Path(arg).name)]),
+                    None)
+        return str(path.absolute()) if path else ""
 
     arg_checks = SimpleNamespace(
         **{"bib_dirs": check_bib_dirs,
@@ -60,9 +69,72 @@ def check_arguments(args: SimpleNamespace, config: configparser.ConfigParser,
     print_("\n")
 
 
+def sync_main(argv):
+    from .output import changes_file
+    from .sync import sync
+    parser = argparse.ArgumentParser(
+        prog="bloggen sync",
+        description="Sync the output files changed since the last sync to a target directory")
+    parser.add_argument("target", help="Target directory or local mirror")
+    parser.add_argument("-i", "--input-dir", default="input",
+                        help="Input directory for the blog contents (default: input)")
+    parser.add_argument("-o", "--output-dir", default="output",
+                        help="Output directory of the blog contents (default: output)")
+    parser.add_argument("--full", action="store_true",
+                        help="Sync all the output files instead of only the changes")
+    parser.add_argument("--keep", action="store_true",
+                        help="Don't clear the pending changes after syncing")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print what would be synced")
+    add_verbosity_args(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    input_dir, output_dir = Path(args.input_dir), Path(args.output_dir)
+    print_(f"Syncing {output_dir}:")
+    sync(changes_file(input_dir, output_dir), output_dir, Path(args.target),
+         full=args.full, keep=args.keep, dry_run=args.dry_run)
+    return 0
+
+
+def stats_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="bloggen stats",
+        description="Show the metrics of the recent builds and flag regressions of the last one")
+    parser.add_argument("-i", "--input-dir", default="input",
+                        help="Input directory for the blog contents (default: input)")
+    parser.add_argument("-n", "--limit", type=int, default=20,
+                        help="Number of recent builds to show and compare (default: 20)")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown or drop in cache hit rate " +
+                        "flagged as a regression (default: 0.25)")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the records of the recent builds as JSON lines")
+    add_verbosity_args(parser)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose - args.quiet)
+    history = load_history(history_file(Path(args.input_dir)))
+    if args.json:
+        import json
+        for record in history[-args.limit:]:
+            print(json.dumps(record, sort_keys=True))
+        return 0
+    return 1 if report_stats(history, args.limit, args.threshold) else 0
+
+
+def record_build(args: argparse.Namespace, metrics: BuildMetrics, out_dir: Path, status: str):
+    "Append the metrics of the build to the history, except on dry run"
+    if not args.dry_run:
+        append_history(history_file(Path(args.input_dir)),
+                       metrics.record(output=out_dir.absolute().name,
+                                      preview=args.preview, status=status))
+
+
 # NOTE: Initialize and export the function
 def main():
-    from .generator import BlogGenerator
+    if len(sys.argv) > 1 and sys.argv[1] == "sync":
+        return sync_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "stats":
+        return stats_main(sys.argv[2:])
     parser = argparse.ArgumentParser()
     parser.add_argument("-a", "--update-all", action="store_true",
                         help="Force update all files regardless of " +
@@ -75,6 +147,8 @@ def main():
                         help="Input directory for the blog contents (default: input)")
     parser.add_argument("--input-pattern", type=str, default="",
                         help="Compile only files matching pattern")
+    parser.add_argument("--input-subdir", type=str, default="",
+                        help="Check only this subdirectory of the input directory for changes")
     parser.add_argument("-o", "--output-dir", default="output",
                         help="Where to output the blog contents (default: output)")
     # FIXME: Unused
@@ -90,7 +164,7 @@ def main():
                         help="Directories to search for bibtex files (default: [bibs])")
     parser.add_argument("--exclude-dirs",
                         default=",".join(["assets", "images", "documents", "tags"]),
-                        help="Dirs to exclude from including in category pages")
+                        help="Dirs to exclude while scanning the input directory")
     parser.add_argument("--citation-style",
                         default="ieee",
                         help="\n".join(["Which citations style to use.",
@@ -102,7 +176,43 @@ def main():
                         help="Generate a blog preview regardless of changes")
     parser.add_argument("-u", "--update-styles", action="store_true",
                         help="Only update the styles, don't generate anything")
+    parser.add_argument("--minify", action="store_true",
+                        help="Minify the generated html and the theme's css and js")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="Number of parallel workers (default: number of CPUs)")
+    parser.add_argument("--image-widths", type=str, default="",
+                        help="Comma separated widths of responsive derivatives of images " +
+                        "in posts, e.g. 480,960,1920. Requires Pillow (default: none)")
+    parser.add_argument("--image-format", type=str, default="webp",
+                        help="Format of the image derivatives (default: webp)")
+    parser.add_argument("--renderer", default="pandoc", choices=["pandoc", "markdown", "auto"],
+                        help="How to render markdown. \"markdown\" renders in process with " +
+                        "markdown-it-py and \"auto\" uses pandoc only for files with " +
+                        "a bibliography, math or pandoc extensions like footnotes " +
+                        "(default: pandoc)")
+    parser.add_argument("--state-backend", default="sqlite", choices=["sqlite", "json"],
+                        help="Storage format of the files data (default: sqlite). " +
+                        "Existing files data in the other format is migrated")
+    parser.add_argument("--render-cache", type=str, default="",
+                        help="Directory for the cache of rendered posts. It can be shared " +
+                        "by different checkouts and machines (default: .bloggen/fragments " +
+                        "in the input directory)")
+    parser.add_argument("--render-cache-size", type=int, default=1024,
+                        help="Maximum size of the render cache in MB. " +
+                        "Least recently used entries are evicted (default: 1024)")
+    parser.add_argument("--related-posts", type=int, default=0,
+                        help="Number of related posts to link from each post. " +
+                        "Requires NumPy and SciPy (default: 0)")
+    parser.add_argument("--check-links", action="store_true",
+                        help="Report internal links to pages or files which don't exist " +
+                        "in the output")
+    parser.add_argument("--fingerprint-assets", action="store_true",
+                        help="Use content hashed names for css and js assets " +
+                        "for long lived caching")
+    add_verbosity_args(parser)
     args = parser.parse_args()
+    setup_logging(args.verbose - args.quiet)
+    metrics = BuildMetrics()
     config = configparser.ConfigParser(default_section="default")
     # NOTE: Config file can contain pandoc generation options also
     if args.config_file and os.path.exists(args.config_file):
@@ -115,43 +225,91 @@ def main():
 
     check_arguments(args, config, parser)
     print_("Checking files:")
-    files = Files(Path(args.input_dir), Path(args.output_dir),
-                  Path(args.input_dir).joinpath(".files_data"),
-                  update_all=args.update_all)
-    files.check_for_changes(include_drafts=args.preview,
-                            input_pattern=args.input_pattern)
+    exclude_dirs = args.exclude_dirs.split(",")
+    bib_dirs = args.bib_dirs.split(",") if isinstance(args.bib_dirs, str) else args.bib_dirs
+    image_widths = sorted(int(x) for x in args.image_widths.split(",") if x.strip())
+    with metrics.phase("check"):
+        files = Files(Path(args.input_dir), Path(args.output_dir),
+                      Path(args.input_dir).joinpath(".files_data"),
+                      update_all=args.update_all, state_backend=args.state_backend,
+                      exclude_dirs=exclude_dirs, input_subdir=args.input_subdir)
+        contact = dict(config["contact"]) if config.has_section("contact") else {}
+        pandoc_config = dict(config["pandoc"]) if config.has_section("pandoc") else {}
+        inputs = BuildInputs(Path(args.themes_dir).joinpath(args.theme, "templates"),
+                             Path(args.csl_dir).joinpath(args.citation_style + ".csl"),
+                             Path(args.variables), pandoc_config, contact, args.renderer,
+                             files.files_data.get("fingerprints"),
+                             related_posts=args.related_posts,
+                             output_opts={"minify": args.minify,
+                                          "fingerprint": args.fingerprint_assets},
+                             image_opts={"widths": image_widths, "format": args.image_format}
+                             if image_widths else None, bib_dirs=bib_dirs)
+        files.check_for_changes(include_drafts=args.preview,
+                                input_pattern=args.input_pattern, inputs=inputs)
+    for name, changes in [("files_new", files.new_files), ("files_changed", files.changed_files),
+                          ("files_deleted", files.deleted_files),
+                          ("inputs_changed", files.changed_inputs)]:
+        metrics.count(name, len(changes))
     if not files.changes:
         print_("No changes to files", "\t")
     if not any([files.changes, args.update_all, args.update_styles]):
         print_("Nothing to do", "\t")
+        if files.stats_changed and not args.preview:
+            with metrics.phase("write_state"):
+                files.write_files_data()
+        if args.check_links:
+            from .links import check_links
+            check_links(Path(args.input_dir), Path(args.output_dir))
+        # NOTE: Builds with nothing to do aren't recorded, so running
+        #       repeatedly doesn't grow the history
         return 0
+    # NOTE: The generator pulls in bs4, lxml and sass so it's imported only
+    #       when there's something to build
+    from .generator import BlogGenerator
     print_("\n")
-    # FIXME: This is unused
-    exclude_dirs = args.exclude_dirs.split(",")
     params = map(Path, [args.input_dir, args.output_dir, args.themes_dir,
                         args.csl_dir, args.variables])
     if args.preview:
         out_dir = Path(args.output_dir).absolute().parent.joinpath("preview")
     else:
-        if files.changes:
-            files.write_files_data()
         out_dir = Path(args.output_dir)
     gen_files = files.generation_files(args.preview)
     if any([files.changes, args.update_all, args.update_styles]):
-        generator = BlogGenerator(*params, args.theme, args.bib_dirs, exclude_dirs,
+        generator = BlogGenerator(*params, args.theme, bib_dirs, exclude_dirs,
                                   args.citation_style, args.dry_run,
-                                  contact={k: v for k, v in config["contact"].items()},
-                                  pandoc_config={k: v for k, v in config["pandoc"].items()})
+                                  contact=contact, pandoc_config=pandoc_config,
+                                  minify=args.minify,
+                                  fingerprint=args.fingerprint_assets,
+                                  jobs=int(args.jobs),
+                                  image_widths=image_widths,
+                                  image_format=args.image_format,
+                                  renderer=args.renderer,
+                                  check_links=args.check_links,
+                                  related_posts=args.related_posts,
+                                  render_cache=Path(args.render_cache).expanduser()
+                                  if args.render_cache else None,
+                                  render_cache_size=args.render_cache_size * 1024 * 1024,
+                                  metrics=metrics, state=files.state)
         if args.update_styles:
             if not out_dir.exists():
-                print("Cannot update styles only in empty dir")
+                warn_("Cannot update styles only in empty dir")
             else:
                 generator.update_styles(out_dir)
         else:
             generator.run_pipeline(out_dir, gen_files,
                                    args.preview, args.update_all,
                                    args.input_pattern)
+        # NOTE: files data is written after the build as the generator adds
+        #       snippets and output paths to it
+        if not (args.preview or args.dry_run):
+            with metrics.phase("write_state"):
+                files.write_files_data()
+        failed = bool(getattr(generator, "errors", None))
+        if not args.update_styles:
+            record_build(args, metrics, out_dir, "failed" if failed else "ok")
+        if failed:
+            return 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,126 @@
+from typing import Dict, List, Optional, Set, Tuple
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+
+from .minify import minify_cached, prune_minify_cache
+from .output import OutputWriter, atomic_write
+
+
+def copy_assets(assets_dir: Path, out_assets_dir: Path, writer: OutputWriter,
+                minify_cache_dir: Optional[Path] = None) -> List[Path]:
+    """Copy `assets_dir` to `out_assets_dir` and return the list of files written.
+
+    Files are written with `writer` so only those which have changed are
+    copied. If `minify_cache_dir` is given then CSS and JS files are minified
+    and the minified output is cached in that directory by content hash.
+    Cached outputs of assets which no longer exist are removed.
+    """
+    written = []
+    used: Set[str] = set()
+    for root, dirs, files in os.walk(assets_dir):
+        dirs.sort()
+        out_root = out_assets_dir.joinpath(os.path.relpath(root, assets_dir))
+        if not out_root.exists():
+            out_root.mkdir(parents=True)
+        for fname in sorted(files):
+            src, dest = Path(root).joinpath(fname), out_root.joinpath(fname)
+            data = minify_cached(src, minify_cache_dir, used) if minify_cache_dir else None
+            if data is None:
+                changed = writer.copy(src, dest)
+            else:
+                changed = writer.write(dest, data)
+            if changed:
+                written.append(dest)
+    if minify_cache_dir:
+        prune_minify_cache(minify_cache_dir, used)
+    return written
+
+
+_fingerprinted = re.compile(r"\.[0-9a-f]{10}(\.(?:css|js))$")
+_asset_ref = re.compile(r"""(?P<attr>href|src)=(?P<q>["'])(?P<prefix>(?:\.\./)*)""" +
+                        r"""(?P<path>assets/[^"'?#]+)(?P=q)""")
+
+
+def fingerprint_name(path: str, digest: str) -> str:
+    "Return the name of `path` with the first 10 characters of `digest` before the suffix"
+    root, ext = os.path.splitext(path)
+    return f"{root}.{digest[:10]}{ext}"
+
+
+def original_name(path: str) -> str:
+    "Return `path` without the digest added by :func:`fingerprint_name`"
+    return _fingerprinted.sub(r"\1", path)
+
+
+def fingerprint_assets(out_dir: Path, writer: OutputWriter,
+                       assets_name: str = "assets") -> Dict[str, str]:
+    """Write content hashed copies of css and js files in `out_dir/assets_name`.
+
+    The original files are left in place so that references which aren't
+    rewritten still work. Return a manifest of original path to hashed path,
+    both relative to `out_dir`.
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(out_dir.joinpath(assets_name)):
+        dirs.sort()
+        for fname in sorted(files):
+            if not fname.endswith((".css", ".js")) or _fingerprinted.search(fname):
+                continue
+            path = Path(root).joinpath(fname)
+            with open(path, "rb") as f:
+                data = f.read()
+            hashed = path.with_name(fingerprint_name(fname, hashlib.sha1(data).hexdigest()))
+            writer.write(hashed, data)
+            manifest[path.relative_to(out_dir).as_posix()] =\
+                hashed.relative_to(out_dir).as_posix()
+    return manifest
+
+
+def remove_stale_fingerprints(out_dir: Path, manifest: Dict[str, str], writer: OutputWriter,
+                              assets_name: str = "assets") -> List[Path]:
+    "Remove hashed copies which are not in `manifest`"
+    current = set(manifest.values())
+    removed = []
+    for root, dirs, files in os.walk(out_dir.joinpath(assets_name)):
+        for fname in files:
+            path = Path(root).joinpath(fname)
+            if _fingerprinted.search(fname) and\
+               path.relative_to(out_dir).as_posix() not in current:
+                writer.remove(path)
+                removed.append(path)
+    return removed
+
+
+def rewrite_asset_refs(page: str, manifest: Dict[str, str]) -> Tuple[str, List[str]]:
+    """Rewrite `href` and `src` references to assets in `page` through `manifest`.
+
+    References to older hashed copies are also rewritten. Return the
+    rewritten page and the sorted list of hashed paths it references.
+    """
+    refs = set()
+
+    def repl(match: re.Match) -> str:
+        key = original_name(match.group("path"))
+        if key not in manifest:
+            return match.group(0)
+        refs.add(manifest[key])
+        return "".join([match.group("attr"), "=", match.group("q"), match.group("prefix"),
+                        manifest[key], match.group("q")])
+    return _asset_ref.sub(repl, page), sorted(refs)
+
+
+def load_json(path: Path) -> Dict:
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    else:
+        return {}
+
+
+def dump_json(path: Path, data: Dict):
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    atomic_write(path, json.dumps(data, indent=1, sort_keys=True).encode("utf-8"))
@@ -0,0 +1,131 @@
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import json
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from .output import atomic_write
+
+
+# NOTE: Bump this when the format of the fragments changes
+CACHE_VERSION = "1"
+
+
+class FragmentCache:
+    """Content addressed cache of rendered html fragments on disk.
+
+    Fragments are stored as JSON files named by their key, which should be a
+    hash of everything which affects the rendering, like the contents of the
+    post and its bibliographies and the renderer options, but not any paths.
+    The cache can then be shared by different checkouts and machines through
+    a common directory. Entries are written atomically so builds can share
+    it concurrently.
+
+    Args:
+        cache_dir: Directory for the cache
+        dry_run: Don't write anything
+        max_size: Maximum size of the cache in bytes. The least recently used
+                  entries are evicted by :meth:`evict` beyond that. 0 for no limit.
+
+    """
+    def __init__(self, cache_dir: Path, dry_run: bool = False, max_size: int = 0):
+        self.cache_dir = cache_dir
+        self.dry_run = dry_run
+        self.max_size = max_size
+        self.added = 0
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                fragment = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self.dry_run:
+            try:                # mark as recently used
+                os.utime(path)
+            except OSError:
+                pass
+        return fragment
+
+    def put(self, key: str, fragment: Dict[str, Any]):
+        if self.dry_run:
+            return
+        path = self.path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        data = json.dumps(fragment, default=str).encode("utf-8")
+        atomic_write(path, data)
+        self.added += len(data)
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        "Return the modification time, size and path of each entry"
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for fname in files:
+                if fname.endswith(".json"):
+                    path = os.path.join(root, fname)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self) -> int:
+        """Remove the least recently used entries beyond :attr:`max_size`.
+
+        Only checked if entries were added, so it costs nothing when nothing
+        was rendered. Return the number of entries removed.
+        """
+        if not self.max_size or not self.added or self.dry_run:
+            return 0
+        entries = sorted(self.entries())
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue        # removed by another build
+            size -= entry_size
+            removed += 1
+        self.added = 0
+        return removed
+
+
+class LRUCache:
+    """A thread safe dictionary of at most `maxsize` items.
+
+    The least recently used item is evicted when it's full.
+
+    Args:
+        maxsize: Maximum number of items
+
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: "OrderedDict[Any, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: Any) -> Any:
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: Any, value: Any):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
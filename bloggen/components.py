@@ -72,6 +72,20 @@ def article_snippet_with_category(snippet: Any, path: str, date: str,
         (f", tags: {tags}</p></article>" if tags else "</p></article>")
 
 
+def related_posts_string(posts: List[Dict[str, str]]) -> str:
+    "Return string for links to related posts. Each post has a `path` and `title`"
+    if not posts:
+        return ""
+    items = "".join(f"""
+    <li><a href="{post['path']}">{post['title']}</a></li>""" for post in posts)
+    return f"""
+<div class="related">
+  <h4>Related posts</h4>
+  <ul>{items}
+  </ul>
+</div>"""
+
+
 def about_snippet(about_path: str, img_path: str, name: str,
                   about_str: str, contact: Dict[str, str]):
     header = f"""
@@ -1,12 +1,12 @@
-from typing import List, Union, Dict
+from typing import List, Optional, Union, Dict, Iterable, Tuple
 import os
 import re
-import json
 import hashlib
-import datetime
 from pathlib import Path
 
 from .util import print_1, extract_metadata
+from .state import get_backend
+from .fingerprints import BuildInputs, dependencies
 
 
 def check_metadata_for(metadata, prop):
@@ -16,25 +16,104 @@ def check_metadata_for(metadata, prop):
         return False
 
 
+def html_name(fname: str) -> str:
+    "Return the name of the html file for post `fname` which may be in a subdirectory"
+    return os.path.basename(fname).replace(".md", ".html")
+
+
+def is_post(path: str) -> bool:
+    "Check if markdown file `path` is a post, that is it has a category"
+    try:
+        metadata = extract_metadata(path)
+    except Exception:
+        return False
+    return isinstance(metadata, dict) and "category" in metadata
+
+
+def scan_input(input_dir: Path, exclude_dirs: Iterable[str] = (), subdir: str = "",
+               suffix: str = ".md") -> Dict[str, Tuple[int, int]]:
+    """Recursively scan `input_dir` for files ending with `suffix`.
+
+    Args:
+        input_dir: The input directory
+        exclude_dirs: Names or paths relative to `input_dir` of directories to skip.
+                      Hidden directories and resource directories of posts,
+                      those with the name of a post beside them, are always skipped.
+        subdir: Scan only this subdirectory of `input_dir`
+        suffix: Suffix of files to include
+
+    Return a dictionary of file path relative to `input_dir` and its size and
+    modification time in ns. The stat is obtained from the directory entries
+    in the same pass so no further syscalls are required.
+
+    """
+    exclude = set(exclude_dirs)
+    files: Dict[str, Tuple[int, int]] = {}
+    stack = [subdir.strip("/")]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(input_dir, rel_dir)) as it:
+            entries = [*it]
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir():
+                if not (entry.name.startswith(".") or entry.name in exclude
+                        or rel_path in exclude or
+                        (entry.name + suffix in names and
+                         is_post(os.path.join(input_dir, rel_path + suffix)))):
+                    stack.append(rel_path)
+            elif entry.name.endswith(suffix) and entry.is_file():
+                st = entry.stat()
+                files[rel_path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
 class Files:
+    """Track the input files and their changes.
+
+    Args:
+        input_dir: Input directory for the blog content
+        output_dir: Output directory for the blog content
+        files_data_file: File in which the files data is stored
+        update_all: Force update all files
+        state_backend: Storage backend for the files data, `sqlite` or `json`.
+                       An existing file in the other format is migrated.
+        exclude_dirs: Directories to skip while scanning `input_dir`
+        input_subdir: Check only this subdirectory of `input_dir` for changes
+
+    Input files are searched recursively in `input_dir` and are identified by
+    their path relative to it.
+
+    """
     def __init__(self, input_dir: Path, output_dir: Path,
-                 files_data_file: Path, update_all: bool):
+                 files_data_file: Path, update_all: bool,
+                 state_backend: str = "sqlite", exclude_dirs: Optional[List[str]] = None,
+                 input_subdir: str = ""):
         self.input_dir = input_dir
+        self.exclude_dirs = exclude_dirs or []
+        self.input_subdir = input_subdir.strip("/")
         self.output_dir = output_dir
         self.files_data_file = files_data_file
         self.update_all = update_all
+        self.state = get_backend(files_data_file, state_backend)
+        self.stats_changed = False
         self.load_files_data()
         self.deleted_files: List[str] = []
         self.new_files: List[str] = []
         self.changed_files: List[str] = []
+        self.changed_inputs: List[str] = []
 
     def generation_files(self, include_drafts):
-        if include_drafts:
-            return self.files_data['files']
-        else:
-            return {k: v for k, v in self.files_data['files'].items()
-                    if not (v["metadata"].get("ignore", "") or
-                            v["metadata"].get("draft", ""))}
+        """Return the files to generate, sorted by name.
+
+        The order of the categories and of the posts with the same date in
+        the generated pages follows it, so it mustn't depend on the order in
+        which files were added or stored.
+        """
+        return {k: v for k, v in sorted(self.files_data['files'].items())
+                if include_drafts or not (v["metadata"].get("ignore", "") or
+                                          v["metadata"].get("draft", ""))}
 
     @property
     def changes(self) -> List[str]:
@@ -42,28 +121,109 @@ class Files:
 
     def load_files_data(self):
         if os.path.exists(self.files_data_file):
-            with open(self.files_data_file) as f:
-                self.files_data = json.load(f)
+            self.files_data = self.state.load()
         else:
             print_1(f"No previous files data found. Will update all files")
             self.files_data = {"files": {}}
         if self.update_all:
             print_1(f"Force updating all files")
             self.files_data = {"files": {}}
-        self.in_files: List[str] = os.listdir(self.input_dir)
+        self.in_files = scan_input(self.input_dir, self.exclude_dirs, self.input_subdir)
 
     def check_for_changes(self, include_drafts: bool = False,
-                          input_pattern: str = ""):
+                          input_pattern: str = "", inputs: Optional[BuildInputs] = None):
+        """Check the input files for changes and mark the files to update.
+
+        If `inputs` are given, files which depend on any of the changed
+        build inputs like templates are also marked for update.
+        """
+        if inputs is not None:
+            self.check_inputs(inputs)
         self.remove_deleted_files_from_files_data()
         self.update_files_data(include_drafts, input_pattern)
+        if inputs is not None:
+            self.check_bibliographies(inputs)
+        self.check_output_names()
+
+    def check_inputs(self, inputs: BuildInputs):
+        if inputs.previous_inputs is None and self.files_data["files"]:
+            print_1("No previous fingerprints of build inputs. Will record them now")
+        self.changed_inputs = sorted(inputs.changed)
+        for name in self.changed_inputs:
+            print_1(f"Build input {name} changed")
+        if inputs.stats_changed or self.changed_inputs or\
+           self.files_data.get("fingerprints") is None:
+            self.stats_changed = True
+        self.files_data["fingerprints"] = inputs.data()
+
+    def check_bibliographies(self, inputs: BuildInputs):
+        """Mark files whose bibliographies changed for update.
+
+        The hashes of the bibliographies of each file are recorded, so that
+        editing a bibliography or changing the directories in which it's
+        found updates the files which cite it.
+        """
+        for fname, fval in sorted(self.files_data["files"].items()):
+            metadata = fval.get("metadata", {})
+            if "bibliography" not in metadata:
+                if fval.pop("bibs", None) is not None:
+                    self.stats_changed = True
+                continue
+            bibs = inputs.bibliographies(metadata["bibliography"])
+            if fval.get("bibs") == bibs:
+                continue
+            if "bibs" in fval and not (check_metadata_for(metadata, "ignore") or
+                                       check_metadata_for(metadata, "draft")):
+                print_1(f"Bibliographies of {fname} changed")
+                fval["update"] = True
+                if fname not in self.changed_files:
+                    self.changed_files.append(fname)
+            fval["bibs"] = bibs
+            self.stats_changed = True
+        if inputs.stats_changed:
+            self.stats_changed = True
+
+    def check_output_names(self):
+        """Raise an error if two posts would be written to the same output file.
+
+        Posts in different subdirectories with the same name and category
+        would otherwise silently overwrite each other.
+        """
+        outputs: Dict[str, str] = {}
+        for fname, fval in sorted(self.files_data["files"].items()):
+            metadata = fval.get("metadata", {})
+            if "category" not in metadata or check_metadata_for(metadata, "ignore"):
+                continue
+            out_path = f"{metadata['category']}/{html_name(fname)}"
+            if out_path in outputs:
+                raise ValueError(f"Both {outputs[out_path]} and {fname} would be written " +
+                                 f"to {out_path}. Rename one of them")
+            outputs[out_path] = fname
+
+    def in_subdir(self, fname: str) -> bool:
+        return not self.input_subdir or fname.startswith(self.input_subdir + "/")
 
     def remove_deleted_files_from_files_data(self):
-        indexed_files = self.files_data["files"].keys()
-        diff = set(indexed_files) - set(self.in_files)
+        indexed_files = filter(self.in_subdir, self.files_data["files"].keys())
+        diff = set(indexed_files) - self.in_files.keys()
         for fname in diff:
             self.deleted_files.append(fname)
             self.files_data["files"].pop(fname)
 
+    def stat_unchanged(self, fname) -> bool:
+        """Check if size and modification time of `fname` are same as recorded.
+
+        This lets unchanged files skip hashing and metadata extraction.
+        The stat is updated if it differs.
+        """
+        stat = [*self.in_files[fname]]
+        if self.files_data["files"][fname].get("stat") == stat and\
+           "metadata" in self.files_data["files"][fname]:
+            return True
+        self.files_data["files"][fname]["stat"] = stat
+        self.stats_changed = True
+        return False
+
     def get_hash_and_metadata(self, fname):
         with open(os.path.join(self.input_dir, fname)) as f:
             hash = hashlib.md5(f.read().encode("utf-8")).hexdigest()
@@ -84,7 +244,8 @@ class Files:
 
     def only_update_if_matching_pattern(self, fname, input_pattern):
         if fname in self.files_data["files"]:
-            if re.match(input_pattern, fname, flags=re.IGNORECASE):
+            if re.match(input_pattern, fname, flags=re.IGNORECASE) or\
+               re.match(input_pattern, os.path.basename(fname), flags=re.IGNORECASE):
                 self.files_data["files"][fname]["update"] = True
             else:
                 self.files_data["files"][fname]["update"] = False
@@ -104,7 +265,9 @@ class Files:
     def mark_for_update_maybe_add_drafts_to_tags(self, fname, metadata):
         if "tags" in metadata and (check_metadata_for(metadata, "ignore") or
                                    check_metadata_for(metadata, "draft")):
-            metadata["tags"] = ",".join([*metadata["tags"].split(","), "drafts"])
+            tags = metadata["tags"].split(",")
+            if "drafts" not in tags:
+                metadata["tags"] = ",".join([*tags, "drafts"])
             self.files_data["files"][fname]["update"] = True
             # self.files_data["files"][fname]["tags"] = ",".join([*tags, "drafts"])
             return True
@@ -116,7 +279,7 @@ class Files:
                 check_metadata_for(metadata, "draft")):
             if "category" in metadata:
                 out_file = os.path.join(self.output_dir, metadata["category"],
-                                        fname.replace(".md", ".html"))
+                                        html_name(fname))
                 if not os.path.exists(out_file):
                     self.files_data["files"][fname]["update"] = True
             else:
@@ -135,6 +298,7 @@ class Files:
 
     def mark_new_file_for_update(self, fname, include_drafts):
         self.files_data["files"][fname] = {}
+        self.stat_unchanged(fname)
         hash, metadata = self.get_hash_and_metadata(fname)
         if self.maybe_mark_file_for_update(fname, hash, metadata, include_drafts):
             self.new_files.append(fname)
@@ -142,28 +306,73 @@ class Files:
 
     def mark_existing_file_for_update(self, fname, include_drafts):
         self.files_data["files"][fname]["update"] = False
-        hash, metadata = self.get_hash_and_metadata(fname)
+        if self.stat_unchanged(fname):
+            hash = self.files_data["files"][fname].get("hash", "")
+            metadata = self.files_data["files"][fname]["metadata"]
+        else:
+            hash, metadata = self.get_hash_and_metadata(fname)
         if self.maybe_mark_file_for_update(fname, hash, metadata, include_drafts):
             self.changed_files.append(fname)
+        elif self.images_changed(fname):
+            print_1(f"Images of {fname} changed")
+            self.files_data["files"][fname]["update"] = True
+            self.changed_files.append(fname)
+        elif self.files_data["files"][fname].get("failed"):
+            print_1(f"Retrying {fname} which failed earlier")
+            self.files_data["files"][fname]["update"] = True
+            self.changed_files.append(fname)
         return metadata
 
+    def images_changed(self, fname: str) -> bool:
+        """Check if any image with derivatives in post `fname` changed.
+
+        The `srcset` of the images depends on their size, so the post has to
+        be generated again.
+        """
+        fval = self.files_data["files"][fname]
+        resources = fval.get("resources", {})
+        post_dir = os.path.dirname(os.path.join(self.input_dir, fname))
+        for rel_path in fval.get("derivatives", {}):
+            try:
+                st = os.stat(os.path.join(post_dir, rel_path))
+            except OSError:
+                return True
+            if resources.get(rel_path) != [st.st_size, st.st_mtime_ns]:
+                return True
+        return False
+
+    def mark_dependents_for_update(self, fname: str, metadata):
+        """Mark `fname` for update if any build input it depends on changed.
+
+        The dependencies with which it was last built are checked and the
+        current dependencies are recorded.
+        """
+        fval = self.files_data["files"][fname]
+        deps = dependencies(fname, metadata)
+        changed = set(fval.get("deps", deps)).intersection(self.changed_inputs)
+        fval["deps"] = deps
+        if changed and not (check_metadata_for(metadata, "ignore") or
+                            check_metadata_for(metadata, "draft")):
+            fval["update"] = True
+            if fname not in self.changed_files:
+                self.changed_files.append(fname)
+
     def update_files_data(self, include_drafts, input_pattern):
-        files = [fname for fname in self.in_files if fname.endswith(".md")]
-        for fname in files:
+        for fname in sorted(self.in_files):
             if fname not in self.files_data["files"]:
                 metadata = self.mark_new_file_for_update(fname, include_drafts)
             else:
                 metadata = self.mark_existing_file_for_update(fname, include_drafts)
+                self.mark_dependents_for_update(fname, metadata)
             if input_pattern:
                 self.only_update_if_matching_pattern(fname, input_pattern)
             self.mark_update_if_index_or_no_out_file(fname, metadata)
+        if self.changed_inputs:
+            # NOTE: Files outside `input_subdir` aren't scanned but they depend
+            #       on the build inputs too, and the fingerprints are stored now
+            for fname in sorted(self.files_data["files"].keys() - self.in_files.keys()):
+                self.mark_dependents_for_update(
+                    fname, self.files_data["files"][fname].get("metadata", {}))
 
     def write_files_data(self):
-        def defaults(o):
-            if isinstance(o, datetime.date):
-                return str(o)
-            else:
-                return o
-        serialized = json.dumps(self.files_data, default=defaults)
-        with open(self.files_data_file, "w") as f:
-            f.write(serialized)
+        self.state.save(self.files_data)
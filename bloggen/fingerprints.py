@@ -0,0 +1,181 @@
+from typing import Any, Dict, List, Optional, Set, Union
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from .util import find_bibliographies
+
+
+# NOTE: Bump this when the pandoc options in BlogGenerator.generate_opts change
+PANDOC_OPTS_VERSION = "1"
+
+
+def digest(data: Any) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str)
+                        .encode("utf-8")).hexdigest()
+
+
+class BuildInputs:
+    """Fingerprints of the inputs of a build other than the content files.
+
+    These are the templates, the CSL file, the pandoc executable and its
+    options, the contact config, the variables and the options which affect
+    the written pages like minification. Each is identified by a
+    name like `template:post` or `variables.titles.research` and the
+    fingerprint is a hash of its contents.
+
+    The bibliographies are fingerprinted per post with :meth:`bibliographies`.
+
+    Files are hashed only if their size or modification time changed since
+    the stat recorded in `previous`. For pandoc, the stat of the executable
+    is used instead of its version, so that pandoc isn't run when there's
+    nothing to build.
+
+    Args:
+        templates_dir: Templates directory of the theme
+        csl_file: The CSL file
+        variables_file: The JSON file with variables like titles
+        pandoc_config: The pandoc section of the config
+        contact: The contact section of the config
+        renderer: The renderer mode
+        previous: Fingerprints stored by the previous build
+        related_posts: Number of related posts for each post
+        output_opts: Options which affect all the written pages, like `minify`
+        image_opts: Options of the image derivatives in posts
+        bib_dirs: Directories to search for bibliographies
+
+    """
+    def __init__(self, templates_dir: Path, csl_file: Path, variables_file: Path,
+                 pandoc_config: Dict[str, str], contact: Dict[str, str], renderer: str,
+                 previous: Optional[Dict[str, Any]] = None, related_posts: int = 0,
+                 output_opts: Optional[Dict[str, Any]] = None,
+                 image_opts: Optional[Dict[str, Any]] = None,
+                 bib_dirs: Optional[List[str]] = None):
+        previous = previous or {}
+        self.previous_inputs: Optional[Dict[str, str]] = previous.get("inputs")
+        self.previous_stats: Dict[str, List] = previous.get("stats", {})
+        self.stats: Dict[str, List] = {}
+        self.bib_dirs = [os.path.abspath(x) for x in bib_dirs or []]
+        self.bib_hashes: Dict[str, Optional[str]] = {}
+        self.stats_changed = False
+        self.inputs: Dict[str, str] = {}
+        self.add_templates(templates_dir)
+        self.inputs["csl"] = self.file_hash(csl_file)
+        self.add_variables(variables_file)
+        pandoc = Path(pandoc_config.get("pandoc_executable", "/usr/bin/pandoc"))
+        self.inputs["renderer"] = digest([renderer, pandoc_config, PANDOC_OPTS_VERSION,
+                                          self.file_stat(pandoc)])
+        img_path = contact.get("img_path")
+        self.inputs["contact"] = digest([contact, img_path and self.file_hash(Path(img_path))])
+        if related_posts:
+            self.inputs["related"] = digest(related_posts)
+        self.inputs["output"] = digest(output_opts or {})
+        self.inputs["images"] = digest(image_opts or {})
+
+    def file_stat(self, path: Path) -> Optional[List]:
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        return [str(path.absolute()), st.st_size, st.st_mtime_ns]
+
+    def file_hash(self, path: Path) -> Optional[str]:
+        "Return the hash of file `path`, or None if it doesn't exist"
+        stat = self.file_stat(path)
+        if stat is None:
+            return None
+        key = stat[0]
+        prev = self.previous_stats.get(key)
+        if prev and prev[:2] == stat[1:]:
+            self.stats[key] = prev
+            return prev[2]
+        with open(path, "rb") as f:
+            h = hashlib.sha1(f.read()).hexdigest()
+        self.stats[key] = [*stat[1:], h]
+        self.stats_changed = True
+        return h
+
+    def bibliographies(self, bib_files: Union[str, List[str]]) -> Dict[str, Optional[str]]:
+        """Return the hash of each of the bibliographies `bib_files` by its path.
+
+        The bibliographies are searched in :attr:`bib_dirs` like when
+        rendering. Names which aren't found map to :code:`None`, so that
+        adding them later is also a change.
+        """
+        hashes: Dict[str, Optional[str]] = {}
+        for name in [bib_files] if isinstance(bib_files, str) else bib_files:
+            paths = find_bibliographies(name, self.bib_dirs)
+            for path in paths:
+                if path not in self.bib_hashes:
+                    self.bib_hashes[path] = self.file_hash(Path(path))
+                hashes[path] = self.bib_hashes[path]
+            if not paths:
+                hashes[name] = None
+        return hashes
+
+    def add_templates(self, templates_dir: Path):
+        """Add fingerprints `template:<name>` for each template in `templates_dir`.
+
+        Other files in the directory may be partials of any template, so they
+        are included in the fingerprint of each template.
+        """
+        if not templates_dir.is_dir():
+            return
+        paths = sorted(p for p in templates_dir.iterdir() if p.is_file())
+        templates = [p for p in paths if p.suffix == ".template"]
+        partials = {p.name: self.file_hash(p) for p in paths if p not in templates}
+        for path in templates:
+            self.inputs[f"template:{path.stem}"] = digest([self.file_hash(path), partials])
+
+    def add_variables(self, variables_file: Path):
+        """Add a fingerprint for each top level key in `variables_file`.
+
+        Keys with dictionary values like `titles` get a fingerprint for each
+        of their keys instead, e.g. `variables.titles.research`.
+        """
+        if not variables_file.is_file():
+            return
+        with open(variables_file) as f:
+            variables = json.load(f)
+        for key, value in variables.items():
+            if isinstance(value, dict):
+                for k, v in value.items():
+                    self.inputs[f"variables.{key}.{k}"] = digest(v)
+            else:
+                self.inputs[f"variables.{key}"] = digest(value)
+
+    @property
+    def changed(self) -> Set[str]:
+        """Names of inputs which changed since the previous build.
+
+        Empty if there's no previous build to compare with.
+        """
+        if self.previous_inputs is None:
+            return set()
+        names = {*self.inputs, *self.previous_inputs}
+        return {x for x in names if self.inputs.get(x) != self.previous_inputs.get(x)}
+
+    def data(self) -> Dict[str, Any]:
+        return {"inputs": self.inputs, "stats": self.stats}
+
+
+def dependencies(fname: str, metadata: Dict[str, Any]) -> List[str]:
+    """Return the names of the build inputs which input file `fname` depends on.
+
+    Posts, which have a category, are filled in the `post` template and the
+    other files like `index.md` in the `index` template. The title of a page
+    is that of its category or its name, with the `index` title as fallback.
+    The CSL file is used only with a bibliography and the image options only
+    in posts.
+    """
+    category = metadata.get("category")
+    deps = ["renderer", "contact", "output", "variables.about", "variables.titles.index"]
+    if category:
+        deps.extend(["template:post", "related", "images", f"variables.titles.{category}"])
+    else:
+        stem = os.path.splitext(os.path.basename(fname))[0]
+        deps.extend(["template:index", f"variables.titles.{stem}"])
+    if "bibliography" in metadata:
+        deps.append("csl")
+    return sorted(set(deps))
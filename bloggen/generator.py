@@ -1,12 +1,16 @@
-from typing import List, Dict, Optional, Union
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Set, Tuple, Union
 import os
 import re
 import sys
 import json
 import shutil
-import tempfile
+import asyncio
+import hashlib
+import threading
+import multiprocessing
 from pathlib import Path
-from subprocess import Popen, PIPE
+from functools import partial
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
 from types import SimpleNamespace
 from bs4 import BeautifulSoup
 from common_pyutil.system import Semver
@@ -14,11 +18,27 @@ from common_pyutil.system import Semver
 from .components import (title_file_string, snippet_string,
                          article_snippet_with_category,
                          snippet_string_with_category,
-                         about_snippet, about_string)
-
-from .util import (find_bibliographies, replace_metadata, print_, print_1,
-                   print_2, compile_sass, shell_command_to_string)
+                         about_snippet, about_string, related_posts_string)
 
+from .util import (print_, print_1, print_2, warn_, warn_1, compile_sass,
+                   shell_command_to_string, extract_metadata, find_bibliographies, BuildError)
+from .renderer import (Fragment, Renderer, PandocRenderer, MarkdownRenderer,
+                       choose_renderer, fill_template)
+from .template import Template
+from .cache import FragmentCache, LRUCache, CACHE_VERSION
+from .scheduler import Scheduler
+from .metrics import BuildMetrics
+from .state import StateBackend
+from .assets import (copy_assets, fingerprint_assets, remove_stale_fingerprints,
+                     rewrite_asset_refs, original_name, load_json, dump_json)
+from .minify import minify_html, minify_js
+from .files import html_name
+from .resources import find_resources, sibling_resources
+from . import images
+from . import links
+from . import related
+from .output import (OutputWriter, changes_file, outputs_file, load_outputs,
+                     dump_outputs, file_digest)
 
 
 class BlogGenerator:
@@ -34,9 +54,39 @@ class BlogGenerator:
                 present in the `themes_dir`
         csl_dir: Directory containing CSL files
         bib_dirs: Directories containing bibtex files
-        exclude_dirs: Directories to exclude while scanning for content
+        exclude_dirs: Directories to exclude while scanning for content.
+                      The scanning is done by :class:`Files`
         citation_style: Citation style to use.
                         The CSL file with that name should be present in `cls_dir`.
+        minify: Minify the generated html and the theme's css and js files.
+        fingerprint: Reference css and js files by content hashed names.
+                     A manifest of names is written to `assets/manifest.json`.
+        jobs: Number of parallel workers for copying files and generating images.
+              Defaults to number of CPUs.
+        image_widths: Widths of responsive derivatives to generate for images
+                      in posts. Requires `Pillow`. Empty for no derivatives.
+        image_format: Format of the image derivatives
+        renderer: How to render markdown. One of `pandoc`, `markdown` or `auto`.
+                  With `markdown` the files are rendered in process with
+                  `markdown-it-py` and with `auto` only those files which have
+                  a bibliography, math or pandoc extensions like footnotes are
+                  rendered with pandoc. A file can also set `renderer` in its
+                  metadata.
+        check_links: Report internal links to files which aren't in the output.
+                     An index of the internal links of each page is kept in
+                     the state dir and only pages written in a build are parsed.
+        related_posts: Number of related posts to link from each post in place
+                       of `$RELATED$` in the post template. Requires NumPy
+                       and SciPy. 0 for none.
+        render_cache: Directory for the cache of rendered posts. It's content
+                      addressed and can be shared by different checkouts.
+                      Defaults to `fragments` in the state dir.
+        render_cache_size: Maximum size of the render cache in bytes.
+                           0 for no limit.
+        metrics: Metrics of the build to which the counters and times of
+                 the generator are added
+        state: Backend of the files data from which the snippets which
+               weren't loaded with it are read
 
     It:
         1. Creates blog_output directory if it doesn't exist
@@ -49,30 +99,68 @@ class BlogGenerator:
            - Generate each post from corresponding markdown with pandoc
            - Update index, tags and categories file each time
            - Delete obsolete html files and folders
-        4. TODO: Handle additional files (like images and stuff for the generated html files)
-        5. Bundles and minifys the html (with external plugin)
+        4. Copies resources of posts like images and attachments
+           - Files in a directory with the same name as the post beside it
+           - Local files linked relatively from the generated html
+        5. Optionally minifies the html, css and js
         6. TODO: Maybe filter by multiple tags with JS
+
+    Errors in generating a page are collected in :attr:`errors` and the build
+    continues with the other pages. Failed posts are marked `failed` in the
+    files data so that they're retried in the next build.
     """
+    # NOTE: Number of snippets read from the state backend to keep in memory
+    snippet_cache_size = 256
+
     def __init__(self, input_dir: Path, output_dir: Path, themes_dir: Path,
                  csl_dir: Path, variables: Path, theme: str, bib_dirs: List[str],
                  exclude_dirs: List[str], citation_style: str, dry_run: bool,
-                 contact=Dict[str, str], pandoc_config=Dict[str, str]):
+                 contact=Dict[str, str], pandoc_config=Dict[str, str],
+                 minify: bool = False, fingerprint: bool = False, jobs: int = 0,
+                 image_widths: Optional[List[int]] = None, image_format: str = "webp",
+                 renderer: str = "pandoc", check_links: bool = False,
+                 related_posts: int = 0, render_cache: Optional[Path] = None,
+                 render_cache_size: int = 0, metrics: Optional[BuildMetrics] = None,
+                 state: Optional[StateBackend] = None):
         print_("Checking Generator Options:")
+        self.metrics = metrics or BuildMetrics()
+        self.state = state
+        self.snippet_cache = LRUCache(self.snippet_cache_size)
         self.dry_run = dry_run
-        self.input_dir = self.check_exists(input_dir)
-        self.output_dir = self.ensure_dir(output_dir)
-        self.theme = self.check_exists(themes_dir.joinpath(theme))
+        # NOTE: Paths are made absolute as tasks run concurrently and
+        #       shouldn't depend on the working directory
+        self.input_dir = self.check_exists(input_dir.absolute())
+        self.output_dir = self.ensure_dir(output_dir.absolute())
+        self.theme = self.check_exists(themes_dir.absolute().joinpath(theme))
         self.templates_dir = self.check_exists(self.theme.joinpath("templates"))
-        with open(self.check_exists(variables)) as f:
+        with open(self.check_exists(variables.absolute())) as f:
             self.variables = json.load(f)
         # TODO: Citations can be optional
-        self.csl_dir = self.check_exists(csl_dir)
+        self.csl_dir = self.check_exists(csl_dir.absolute())
         self.assets_dir = self.check_exists(self.theme.joinpath("assets"))
-        self.bib_dirs = bib_dirs
-        self.hosted_paths = ["assets", "tags", ".git"]
-        # FIXME: This is unused
+        self.bib_dirs = [os.path.abspath(x) for x in bib_dirs]
         self.exclude_dirs = exclude_dirs
         self.files_data_file = self.input_dir.joinpath(".files_data")
+        self.state_dir = self.input_dir.joinpath(".bloggen")
+        self.minify = minify
+        self.fingerprint = fingerprint
+        self.asset_manifest: Dict[str, str] = {}
+        self.asset_refs: Dict[str, List[str]] = {}
+        self.written_pages: List[str] = []
+        self.page_links: Dict[str, List[str]] = {}
+        self.check_links = check_links
+        self.related_posts = related_posts
+        if self.related_posts:
+            related.check_numpy()
+        self.jobs = jobs or os.cpu_count() or 1
+        self.image_widths = sorted(image_widths or [])
+        self.image_format = image_format
+        if self.image_widths:
+            images.check_pillow()
+        self.renderer_mode = renderer
+        self.render_cache = render_cache.absolute() if render_cache\
+            else self.state_dir.joinpath("fragments")
+        self.render_cache_size = render_cache_size
         self.pandoc_config = pandoc_config
         self.contact = contact
         self.set_pandoc_opts()
@@ -80,17 +168,16 @@ class BlogGenerator:
 
     def set_pandoc_opts(self):
         self.pandoc_cmd = self.check_exists(
-            Path(self.pandoc_config.get("pandoc_executable", "/usr/bin/pandoc")))
+            Path(self.pandoc_config.get("pandoc_executable", "/usr/bin/pandoc")).absolute())
         out, err = shell_command_to_string(str(self.pandoc_cmd) + " --version")
         if not err:
             self.pandoc_version = out.split()[1]
         else:
-            print_1("Pandoc error.")
-            sys.exist(1)
+            warn_1("Pandoc error.")
+            sys.exit(1)
         print_1(f"Will use pandoc {self.pandoc_cmd}, version {self.pandoc_version}")
 
     def generate_opts(self, citation_style):
-        self.snippet_cache: Dict[str, SimpleNamespace] = {}
         self.general_opts = " ".join(["-r markdown+simple_tables+table_captions+" +
                                       "yaml_metadata_block+fenced_code_blocks+raw_html",
                                       "-t html"])
@@ -100,23 +187,28 @@ class BlogGenerator:
             self.reader_opts = "--citeproc"
         self.index_template = self.check_exists(self.templates_dir.joinpath("index.template"))
         self.post_template = self.check_exists(self.templates_dir.joinpath("post.template"))
-        self.writer_opts = " ".join([f"--template={self.index_template}",
-                                     f"-V templates_dir={self.templates_dir}",
-                                     "--toc"])
+        # NOTE: Templates are compiled once and filled in process with the
+        #       rendered fragments
+        self.templates = {path: Template.from_file(path)
+                          for path in [self.index_template, self.post_template]}
         self.csl_file = self.csl_dir.joinpath(citation_style + ".csl")
         if not self.csl_file.exists():
             raise FileNotFoundError(self.csl_file)
         self.citation_opts = f"--csl={self.csl_file}"
-        self.index_cmd = " ".join(map(str, [self.pandoc_cmd, self.general_opts,
-                                            self.reader_opts, self.writer_opts.replace("--toc", ""),
-                                            self.citation_opts]))
-        self.tag_cmd = self.index_cmd
-        self.category_cmd = self.index_cmd
-        self.post_cmd = " ".join(map(str, [self.pandoc_cmd, self.general_opts,
-                                           self.reader_opts, self.writer_opts,
-                                           self.citation_opts])).replace(
-                                               "index.template", "post.template")
-        print("\n")
+        self.csl_hash = file_digest(self.csl_file)
+        self.bib_hashes: Dict[str, str] = {}
+        self.fragment_cache = FragmentCache(self.render_cache, self.dry_run,
+                                            self.render_cache_size)
+        # NOTE: Template options are added by the PandocRenderer
+        self.pandoc_base_cmd = " ".join(map(str, [self.pandoc_cmd, self.general_opts,
+                                                  self.reader_opts, self.citation_opts]))
+        self.pandoc = PandocRenderer(self.templates_dir, self.pandoc_base_cmd, self.bib_dirs,
+                                     " ".join([self.general_opts, self.reader_opts]),
+                                     self.state_dir)
+        self.markdown = MarkdownRenderer(self.templates_dir)\
+            if self.renderer_mode != "pandoc" else None
+        print_1(f"Will use renderer mode {self.renderer_mode}")
+        print_("\n")
 
     def check_exists(self, path: Path) -> Path:
         print_1(f"Checking for {path}")
@@ -144,26 +236,146 @@ class BlogGenerator:
         self._index_data = x
 
     def update_styles(self, out_dir: Path):
+        out_dir = out_dir.absolute()
+        self.out_dir = out_dir
+        self.writer = OutputWriter(out_dir, self.dry_run)
         self.copy_assets_dir(out_dir)
+        self.fingerprint_assets_dir(out_dir)
+        self.update_asset_refs(out_dir)
+        self.report_changes(out_dir)
 
     def run_pipeline(self, out_dir: Path, files_data: Dict[str, Dict],
                      preview: bool, update_all: bool, input_pattern: str):
-        out_dir = self.ensure_dir(out_dir)
+        out_dir = self.ensure_dir(out_dir.absolute())
+        self.out_dir = out_dir
+        self.writer = OutputWriter(out_dir, self.dry_run)
+        self.copied_about_imgs: Set[Path] = set()
+        self.errors: Dict[str, str] = {}
         if preview:
-            print("Generating Preview:")
+            print_("Generating Preview:")
             if out_dir != self.output_dir:
-                self.copy_output_to_preview(out_dir)
+                with self.metrics.phase("preview_copy"):
+                    self.copy_output_to_preview(out_dir)
         else:
-            print("Building Pages:")
-        self.copy_assets_dir(out_dir)
-        self.load_titles(out_dir)
+            print_("Building Pages:")
         self.files_data = files_data
-        self.update_category_and_post_pages(out_dir)
-        if self.index_data:     # only if updates needed
-            self.generate_index_page(out_dir, self.index_data)
-        self.generate_tag_pages(out_dir)
-        self.generate_other_pages(out_dir)
-        self.cleanup(out_dir)
+        with self.metrics.phase("pages"):
+            self.update_category_and_post_pages(out_dir)
+        with self.metrics.phase("other_pages"):
+            self.generate_other_pages(out_dir)
+        with self.metrics.phase("evict"):
+            self.evict_render_cache()
+        with self.metrics.phase("cleanup"):
+            self.cleanup(out_dir)
+        with self.metrics.phase("asset_refs"):
+            self.update_asset_refs(out_dir)
+        with self.metrics.phase("links"):
+            self.update_links(out_dir)
+        self.report_changes(out_dir)
+        self.report_errors()
+
+    def evict_render_cache(self):
+        removed = self.fragment_cache.evict()
+        if removed:
+            print_1(f"Evicted {removed} entries from render cache {self.render_cache}")
+
+    def record_error(self, name: str, error: Exception):
+        warn_1(f"Error generating {name}: {error}")
+        self.metrics.count("errors")
+        self.errors[name] = str(error)
+
+    def report_errors(self):
+        "Print a summary of the errors in the build"
+        if self.errors:
+            warn_(f"{len(self.errors)} files failed. They'll be retried in the next build:")
+            for name, error in sorted(self.errors.items()):
+                warn_1(f"{name}: {error.splitlines()[0] if error else ''}")
+
+    def fragment_key(self, renderer_name: str, options: str, in_file: Path,
+                     metadata: Dict) -> str:
+        """Return the cache key of the fragment of `in_file`.
+
+        It's a hash of the renderer, its options, the pandoc version, the CSL
+        file, the contents of `in_file` and of its bibliographies. As it
+        doesn't depend on any paths, the cache can be shared across checkouts.
+        """
+        h = hashlib.sha1("\0".join([CACHE_VERSION, renderer_name, options, self.pandoc_version,
+                                     self.csl_hash]).encode("utf-8"))
+        with open(in_file, "rb") as f:
+            h.update(f.read())
+        if "bibliography" in metadata:
+            for bib_file in find_bibliographies(metadata["bibliography"], self.bib_dirs):
+                if bib_file not in self.bib_hashes:
+                    self.bib_hashes[bib_file] = file_digest(bib_file)
+                h.update(self.bib_hashes[bib_file].encode("utf-8"))
+        return h.hexdigest()
+
+    def cached_fragment(self, in_file: Path, metadata: Dict
+                        ) -> Tuple[Renderer, str, Optional[Fragment]]:
+        "Choose the renderer for `in_file` and return it with the cache key and cached fragment"
+        renderer = choose_renderer(self.renderer_mode, in_file, metadata,
+                                   self.pandoc, self.markdown)
+        key = self.fragment_key(renderer.name, renderer.options, in_file, metadata)
+        return renderer, key, self.fragment_cache.get(key)
+
+    async def render(self, in_file: Path, metadata: Dict, template: Path,
+                     toc: bool = False) -> str:
+        """Render `in_file` with the renderer chosen for it and fill `template`
+
+        The rendered fragment is cached so that only the template is filled
+        again if just the templates or variables change. Reading the files
+        and the cache and filling the template is done in a thread, so that
+        the event loop isn't blocked.
+        """
+        loop = asyncio.get_running_loop()
+        renderer, key, fragment = await loop.run_in_executor(None, self.cached_fragment,
+                                                             in_file, metadata)
+        if fragment is None:
+            self.metrics.count("fragment_cache_misses")
+            self.metrics.count(f"{renderer.name}_runs")
+            fragment = await renderer.render_fragment(in_file, metadata)
+            await loop.run_in_executor(None, self.fragment_cache.put, key, fragment)
+        else:
+            self.metrics.count("fragment_cache_hits")
+        self.metrics.count("pages_rendered")
+        return await loop.run_in_executor(None, fill_template, self.templates[template],
+                                          fragment, self.templates_dir, toc)
+
+    def page_metadata(self, in_file: Path) -> Dict[str, Any]:
+        "Return the metadata of a listing page `in_file`, which may not have any"
+        if not in_file.exists():
+            raise BuildError(f"File {in_file} doesn't exist")
+        try:
+            metadata = extract_metadata(str(in_file))
+        except Exception:
+            metadata = {}
+        return metadata if isinstance(metadata, dict) else {}
+
+    async def render_page(self, name: str) -> Optional[str]:
+        """Render skeleton of a listing page like `index.md` from the input dir.
+
+        Return :code:`None` if it fails and record the error.
+        """
+        in_file = self.input_dir.joinpath(name)
+        try:
+            metadata = await asyncio.get_running_loop().run_in_executor(
+                None, self.page_metadata, in_file)
+            return await self.render(in_file, metadata, self.index_template)
+        except Exception as e:
+            self.record_error(name, e)
+            return None
+
+    def report_changes(self, out_dir: Path):
+        """Print the number of changed output files and add them to the pending changes"""
+        print_1(f"{len(self.writer.changed)} output files changed, " +
+                f"{len(self.writer.unchanged)} unchanged, {len(self.writer.deleted)} deleted")
+        if not self.dry_run:
+            self.writer.dump_changes(changes_file(self.input_dir, out_dir))
+        for name, paths in [("outputs_changed", self.writer.changed),
+                            ("outputs_unchanged", self.writer.unchanged),
+                            ("outputs_deleted", self.writer.deleted)]:
+            self.metrics.count(name, len(paths))
+        self.metrics.count("bytes_written", self.writer.bytes_written)
 
     def copy_output_to_preview(self, preview_dir):
         if self.dry_run:
@@ -184,11 +396,168 @@ class BlogGenerator:
         else:
             compile_sass(self.assets_dir)
             print_1(f"Copying {self.assets_dir} to {out_dir}")
-            out_assets_dir = os.path.join(out_dir, str(self.assets_dir).split("/")[-1])
-            shutil.copytree(self.assets_dir, out_assets_dir, dirs_exist_ok=True)  # type: ignore
+            out_assets_dir = out_dir.joinpath(self.assets_dir.name)
+            minify_cache_dir = self.state_dir.joinpath("minify") if self.minify else None
+            copied = copy_assets(self.assets_dir, out_assets_dir, self.writer, minify_cache_dir)
+            print_2(f"{len(copied)} asset files changed")
             if abouts := self.variables.get("about", None):
-                with open(Path(out_assets_dir).joinpath("js/about.js"), "w") as f:
-                    f.write(about_string(abouts))
+                self.write_page(out_assets_dir.joinpath("js/about.js"), about_string(abouts))
+
+    def assets_task(self, name: str, func: Callable[[Path], None], out_dir: Path):
+        """Run `func` which writes assets to `out_dir` as task `name` of the scheduler.
+
+        If it fails, the error is recorded like that of a page and the
+        existing assets are kept, so that the pages can still be written.
+        """
+        try:
+            func(out_dir)
+        except Exception as e:
+            self.record_error(name, e)
+            self.keep_assets(out_dir)
+
+    def keep_assets(self, out_dir: Path):
+        """Keep the existing assets in `out_dir`.
+
+        If assets are fingerprinted, the manifest of the previous build is
+        used so that the pages refer to the existing hashed copies.
+        """
+        out_assets_dir = out_dir.joinpath(self.assets_dir.name)
+        for root, _, files in os.walk(out_assets_dir):
+            for fname in files:
+                self.writer.keep(os.path.join(root, fname))
+        if self.fingerprint and not self.asset_manifest:
+            self.asset_manifest = load_json(out_assets_dir.joinpath("manifest.json"))
+            self.asset_refs = load_json(self.asset_refs_file(out_dir))
+
+    def fingerprint_assets_dir(self, out_dir: Path):
+        """Write content hashed copies of css and js assets and their manifest"""
+        if not self.fingerprint:
+            return
+        if self.dry_run:
+            print_1(f"Not fingerprinting assets in {out_dir} as dry run")
+            return
+        self.asset_manifest = fingerprint_assets(out_dir, self.writer, self.assets_dir.name)
+        self.writer.write(out_dir.joinpath(self.assets_dir.name, "manifest.json"),
+                          json.dumps(self.asset_manifest, indent=1, sort_keys=True))
+        self.asset_refs = load_json(self.asset_refs_file(out_dir))
+
+    def asset_refs_file(self, out_dir: Path) -> Path:
+        return self.state_dir.joinpath(f"asset_refs_{out_dir.absolute().name}.json")
+
+    def update_asset_refs(self, out_dir: Path):
+        """Rewrite pages which weren't generated in this build but refer to changed assets.
+
+        Stale hashed copies of assets are removed after that.
+        """
+        if self.dry_run:
+            return
+        if not self.fingerprint:
+            self.remove_asset_refs(out_dir)
+            return
+        current = set(self.asset_manifest.values())
+        for rel_path, refs in [*self.asset_refs.items()]:
+            path = out_dir.joinpath(rel_path)
+            if rel_path in self.written_pages or set(refs).issubset(current):
+                continue
+            if not path.exists():
+                self.asset_refs.pop(rel_path)
+                continue
+            print_2(f"Updating asset references in {rel_path}")
+            with open(path) as f:
+                page = f.read()
+            page, self.asset_refs[rel_path] = rewrite_asset_refs(page, self.asset_manifest)
+            self.page_links[rel_path] = links.internal_links(page, rel_path)
+            self.writer.write(path, page)
+        remove_stale_fingerprints(out_dir, self.asset_manifest, self.writer,
+                                  self.assets_dir.name)
+        dump_json(self.asset_refs_file(out_dir), self.asset_refs)
+
+    def remove_asset_refs(self, out_dir: Path):
+        """Rewrite references to hashed assets back to the original names.
+
+        This is required when fingerprinting is turned off, for pages which
+        were generated with it and weren't generated again in this build.
+        """
+        path = self.asset_refs_file(out_dir)
+        if not path.exists():
+            return
+        for rel_path, refs in load_json(path).items():
+            page_path = out_dir.joinpath(rel_path)
+            if rel_path in self.written_pages or not refs or not page_path.exists():
+                continue
+            print_2(f"Removing hashed asset references in {rel_path}")
+            with open(page_path) as f:
+                page = f.read()
+            page, _ = rewrite_asset_refs(page, {original_name(x): original_name(x)
+                                                for x in refs})
+            self.page_links[rel_path] = links.internal_links(page, rel_path)
+            self.writer.write(page_path, page)
+        remove_stale_fingerprints(out_dir, {}, self.writer, self.assets_dir.name)
+        os.remove(path)
+
+    def prepare_page(self, path: Path, page: str, refs: Set[str],
+                     page_links: Set[str], part: bool = False) -> str:
+        """Minify `page` or a `part` of it if required.
+
+        If assets are fingerprinted then asset references in html pages are
+        rewritten to the hashed names. The hashed names and the internal
+        links in the page are added to `refs` and `page_links`.
+        """
+        if self.minify:
+            if path.suffix == ".html":
+                page = minify_html(page, strip=not part)
+            elif path.suffix == ".js":
+                page = minify_js(page)
+        if path.suffix == ".html":
+            if self.fingerprint:
+                page, page_refs = rewrite_asset_refs(page, self.asset_manifest)
+                refs.update(page_refs)
+            page_links.update(links.internal_links(page, self.writer.rel_path(path)))
+        return page
+
+    def record_page(self, path: Path, refs: Set[str], page_links: Set[str]):
+        if path.suffix == ".html":
+            rel_path = self.writer.rel_path(path)
+            if self.fingerprint:
+                self.asset_refs[rel_path] = sorted(refs)
+            self.written_pages.append(rel_path)
+            self.page_links[rel_path] = sorted(page_links)
+
+    def write_page(self, path: Union[str, Path], page: str):
+        "Write `page` to `path` with the output writer after :meth:`prepare_page`"
+        path = Path(path)
+        refs: Set[str] = set()
+        page_links: Set[str] = set()
+        self.writer.write(path, self.prepare_page(path, page, refs, page_links))
+        self.record_page(path, refs, page_links)
+
+    def write_page_stream(self, path: Union[str, Path], chunks: Iterable[str]):
+        """Write a page from `chunks` as they're generated.
+
+        Like :meth:`write_page` but each chunk is prepared separately, so the
+        whole page is never held in memory.
+        """
+        path = Path(path)
+        refs: Set[str] = set()
+        page_links: Set[str] = set()
+        self.writer.write_stream(path, (self.prepare_page(path, chunk, refs, page_links, True)
+                                        for chunk in chunks))
+        self.record_page(path, refs, page_links)
+
+    def update_links(self, out_dir: Path):
+        """Update the index of internal links with the pages written in this build.
+
+        Links of pages which weren't written are taken from the index so
+        that they aren't parsed again. If :attr:`check_links`, then the links
+        are checked against the output files.
+        """
+        index_file = links.links_file(self.input_dir, out_dir)
+        outputs = self.writer.outputs - self.writer.deleted
+        page_links = links.update_links(links.load_links(index_file), self.page_links, outputs)
+        if not self.dry_run:
+            links.dump_links(index_file, page_links)
+        if self.check_links:
+            links.report_broken_links(links.broken_links(page_links, outputs, out_dir))
 
     def load_titles(self, out_dir):
         print_1("Generating title files")
@@ -196,32 +565,29 @@ class BlogGenerator:
         # tf_string = title_file_string()
         for k, v in self.titles.items():
             print_1(f"Generated titles for {k}")
-            if self.dry_run:
-                print_1(f"Not writing titles for {k} as dry run")
-            else:
-                with open(os.path.join(out_dir, f"assets/js/{k}_titles.js"), "w") as f:
-                    # f.write(tf_string.replace("$TITLES$", str(v)))
-                    f.write(title_file_string(v))
+            # tf_string.replace("$TITLES$", str(v))
+            self.write_page(Path(out_dir).joinpath(f"assets/js/{k}_titles.js"),
+                            title_file_string(v))
 
-    def generate_post_page(self, post_file, metadata):
-        if "bibliography" in metadata:
-            bib_files = find_bibliographies(metadata["bibliography"], self.bib_dirs)
-            with tempfile.NamedTemporaryFile(mode="r+", prefix="bloggen-") as tp:
-                with open(post_file) as pf:
-                    post = pf.read()
-                metadata["bibliography"] = bib_files
-                tp.write(replace_metadata(post, metadata))
-                tp.flush()
-                p = Popen(f"{self.post_cmd} {tp.name}",
-                          shell=True, stdout=PIPE, stderr=PIPE)
-                out, err = p.communicate()
-        else:
-            p = Popen(f"{self.post_cmd} {post_file}",
-                      shell=True, stdout=PIPE, stderr=PIPE)
-            out, err = p.communicate()
-        if err:
-            print_1(err)
-        page = out.decode("utf-8")
+    async def render_post(self, out_dir: Path, fname: str, fval: Dict) -> Optional[str]:
+        """Render post `fname` if it has to be updated.
+
+        Return :code:`None` if it doesn't or if it fails, in which case the
+        failure is recorded.
+        """
+        out_file = os.path.join(out_dir, fval["metadata"]["category"], html_name(fname))
+        if not fval["update"] and os.path.exists(out_file):
+            self.metrics.count("pages_skipped")
+            return None
+        print_1(f"Generating post {fname}")
+        try:
+            return await self.render(self.input_dir.joinpath(fname), fval["metadata"],
+                                     self.post_template, toc=True)
+        except Exception as e:
+            self.post_failed(out_dir, fname, e)
+            return None
+
+    def generate_post_page(self, page, metadata):
         date = metadata["date"]
         tags = metadata["tags"].split(",")
         tags = [t.strip().replace(" ", "_").lower() for t in tags
@@ -238,26 +604,343 @@ class BlogGenerator:
         page = self.fix_title(category, page, prefix=True)
         return page
 
+    def copy_resource(self, src: Path, dest: Path):
+        if not self.dry_run and not dest.parent.exists():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+        self.writer.copy(src, dest)
+
+    def copy_post_resources(self, out_dir: Path, fname: str, fval: Dict,
+                            pool: Executor, page: Optional[str] = None
+                            ) -> Tuple[List[Future], Dict[str, Path], Dict[str, List[int]]]:
+        """Copy the resources of post `fname` to its category directory in `out_dir`.
+
+        If the post was generated in this build, the resources are searched
+        in the generated `page`, otherwise the ones recorded earlier and those
+        in its sibling directory are checked. Only resources whose stat
+        changed since it was recorded in the files data are copied. The
+        copying is done in the `pool`.
+
+        Return the futures of copying, the resources which were copied and
+        the stat of each resource, which is recorded in the files data only
+        after the copying succeeds.
+        """
+        post_file = self.input_dir.joinpath(fname)
+        if page is None:
+            resources = {**{k: post_file.parent.joinpath(k) for k in fval.get("resources", {})},
+                         **sibling_resources(post_file)}
+        else:
+            resources = find_resources(post_file, page)
+        recorded = fval.get("resources", {})
+        current = {}
+        futures = []
+        changed = {}
+        for rel_path, src in resources.items():
+            if not src.exists():
+                continue
+            st = src.stat()
+            current[rel_path] = [st.st_size, st.st_mtime_ns]
+            dest = out_dir.joinpath(fval["metadata"]["category"], rel_path)
+            self.claim_resource(fname, src, dest)
+            if recorded.get(rel_path) == current[rel_path] and dest.exists():
+                self.writer.keep(dest)
+            else:
+                futures.append(pool.submit(self.copy_resource, src, dest))
+                changed[rel_path] = src
+        return futures, changed, current
+
+    def claim_resources(self, out_dir: Path):
+        """Record the output paths of the resources of posts which aren't updated.
+
+        These are copied from their recorded sources, so that a post which is
+        generated in this build can't overwrite them with another file.
+        """
+        self.resource_owners: Dict[Path, Tuple[str, Path]] = {}
+        self.resource_lock = threading.Lock()
+        for fname, fval in self.files_data.items():
+            if "category" in fval["metadata"] and not fval["update"]:
+                post_dir = self.input_dir.joinpath(fname).parent
+                for rel_path in fval.get("resources", {}):
+                    dest = out_dir.joinpath(fval["metadata"]["category"], rel_path)
+                    self.resource_owners.setdefault(dest, (fname, post_dir.joinpath(rel_path)))
+
+    def claim_resource(self, fname: str, src: Path, dest: Path):
+        """Claim output path `dest` for resource `src` of post `fname`.
+
+        Posts in different subdirectories of a category can have resources
+        with the same relative path. Raise :class:`BuildError` if `dest` was
+        claimed for a different file.
+        """
+        with self.resource_lock:
+            owner, owner_src = self.resource_owners.setdefault(dest, (fname, src))
+        if owner_src != src:
+            raise BuildError(f"Both {os.path.relpath(owner_src, self.input_dir)} of {owner} " +
+                             f"and {os.path.relpath(src, self.input_dir)} of {fname} would " +
+                             f"be written to {self.writer.rel_path(dest)}. Rename one of them")
+
+    def generate_image_derivatives(self, out_dir: Path, fname: str, fval: Dict,
+                                   pool: Executor, resources: Dict[str, List[int]],
+                                   changed: Dict[str, Path], page: Optional[str] = None
+                                   ) -> Tuple[List, Optional[str], Dict[str, List[int]]]:
+        """Generate responsive derivatives of images in `resources` of post `fname`.
+
+        Derivatives are generated in the process `pool` for images which
+        changed or whose derivatives don't exist. For others the existing
+        derivatives are kept. If the post was generated, the `<img>` tags in
+        `page` are rewritten with a `srcset` of the derivatives.
+
+        Return the list of pending jobs, the page and the derivative widths
+        of each image, which are recorded in the files data only after the
+        jobs succeed.
+        """
+        post_file = self.input_dir.joinpath(fname)
+        cat_dir = out_dir.joinpath(fval["metadata"]["category"])
+        cache_dir = str(self.state_dir.joinpath("images"))
+        recorded = fval.get("derivatives", {})
+        derivatives = {}
+        jobs = []
+        for rel_path in filter(images.is_image, resources):
+            src = post_file.parent.joinpath(rel_path)
+            widths = recorded.get(rel_path)
+            dests = [cat_dir.joinpath(images.derivative_name(rel_path, w, self.image_format))
+                     for w in widths or []]
+            if rel_path in changed or not widths or not all(map(os.path.exists, dests)):
+                derivatives[rel_path] = images.image_widths(src, self.image_widths)
+                future = pool.submit(images.make_derivatives, str(src), cache_dir,
+                                     self.image_widths, self.image_format, 80)
+                jobs.append((future, cat_dir, rel_path))
+            else:
+                derivatives[rel_path] = widths
+                for dest in dests:
+                    self.writer.keep(dest)
+        if page is not None:
+            page = images.add_srcsets(page, derivatives, self.image_format)
+        return jobs, page, derivatives
+
+    def copy_image_derivatives(self, jobs: List):
+        for future, cat_dir, rel_path in jobs:
+            for width, cache_file in future.result().items():
+                self.copy_resource(Path(cache_file), cat_dir.joinpath(
+                    images.derivative_name(rel_path, width, self.image_format)))
+
     # TODO: code formatting for programming stuff
-    def generate_posts(self, out_dir):
+    def generate_post(self, out_dir: Path, fname: str, fval: Dict, pool: Executor,
+                      img_pool: Optional[Executor], page: Optional[str]
+                      ) -> Tuple[List[Future], List, Dict[str, Dict]]:
+        """Write post `fname` if it was rendered to `page` and copy its resources.
+
+        Return the futures of copying resources, the image derivative jobs
+        and the `resources` and `derivatives` to record in the files data
+        once they're done.
+        """
+        out_file = os.path.join(out_dir, fval["metadata"]["category"], html_name(fname))
+        if page is not None:
+            fval["snippet"] = None      # parsed again from the new html
+            fval["out_path"] = Path(os.path.relpath(out_file, out_dir)).as_posix()
+            page = self.generate_post_page(page, fval["metadata"])
+            page = page.replace("$RELATED$", self.related_posts_html(fval))
+        else:
+            self.writer.keep(out_file)
+        futures, changed, resources = self.copy_post_resources(out_dir, fname, fval, pool, page)
+        image_jobs: List = []
+        derivatives: Dict[str, List[int]] = {}
+        if img_pool:
+            image_jobs, page, derivatives = self.generate_image_derivatives(
+                out_dir, fname, fval, img_pool, resources, changed, page)
+        if page is not None:
+            page = self.add_about(out_dir, page, True)
+            self.write_page(out_file, page)
+        return futures, image_jobs, {"resources": resources, "derivatives": derivatives}
+
+    def post_failed(self, out_dir: Path, fname: str, error: Exception):
+        """Record failure of post `fname`.
+
+        The post is marked for retry and its existing outputs, if any, are kept.
+        """
+        self.record_error(fname, error)
+        fval = self.files_data[fname]
+        fval["failed"] = True
+        fval["update"] = True
+        self.keep_post_outputs(out_dir, fname, fval)
+
+    def keep_post_outputs(self, out_dir: Path, fname: str, fval: Dict):
+        "Keep the existing html, resources and image derivatives of post `fname`"
+        cat_dir = out_dir.joinpath(fval["metadata"]["category"])
+        self.writer.keep(cat_dir.joinpath(html_name(fname)))
+        for rel_path in fval.get("resources", {}):
+            self.writer.keep(cat_dir.joinpath(rel_path))
+        for rel_path, widths in fval.get("derivatives", {}).items():
+            for width in widths:
+                self.writer.keep(cat_dir.joinpath(
+                    images.derivative_name(rel_path, width, self.image_format)))
+
+    def write_post(self, out_dir: Path, fname: str, fval: Dict, pool: Executor,
+                   img_pool: Optional[Executor], page: Optional[str]):
+        """Write post `fname` rendered to `page` and wait for its resources to be copied.
+
+        This is run as a task of the :class:`Scheduler` after the post is
+        rendered and the assets are fingerprinted. The resources and image
+        derivatives are recorded in the files data only if all of them are
+        done, so that failed ones are retried with the post.
+        """
+        if fname in self.errors:
+            return
+        try:
+            futures, image_jobs, record = self.generate_post(out_dir, fname, fval, pool,
+                                                             img_pool, page)
+            for future in futures:
+                future.result()
+            self.copy_image_derivatives(image_jobs)
+        except Exception as e:
+            self.post_failed(out_dir, fname, e)
+            return
+        for key, value in record.items():
+            if value:
+                fval[key] = value
+            else:
+                fval.pop(key, None)
+
+    def category_data(self, out_dir: Path, cat: str, pages: List[str]) -> Iterator[Dict]:
+        "Generate the data for snippets of posts `pages` in category `cat`"
+        for page in pages:
+            try:
+                snippet = self.snippet_for(out_dir, page)
+            except FileNotFoundError:
+                continue    # post failed and has no earlier output
+            temp = {}
+            temp["date"] = self.files_data[page]["metadata"]["date"]
+            tags = self.files_data[page]["metadata"]["tags"]
+            tags = [t.strip().lower() for t in tags.split(",")
+                    if t.strip().lower() not in self.categories]
+            temp["tags"] = [t.replace(" ", "_").lower() for t in tags]
+            temp["snippet"] = snippet
+            temp["path"] = "/".join([cat, html_name(page)])
+            yield temp
+
+    def generate_category(self, out_dir: Path, cat: str, pages: List[str],
+                          page: Optional[str]) -> List[Dict]:
+        """Generate the page for category `cat`.
+
+        Return the data of its latest post for the index page.
+        """
+        # - filter by tags may only work with javascript
+        # - page.insert snippet with a <next> for let's say 5-6 results per page
+        # if noscript then show everything (no <next> tags)
+        print_1(f"Generating category {cat} page")
+        try:
+            self.generate_category_page(out_dir, cat, self.category_data(out_dir, cat, pages),
+                                        page)
+            latest = next(self.category_data(out_dir, cat, pages), None)
+        except Exception as e:
+            self.record_error(f"{cat}.md", e)
+            self.writer.keep(out_dir.joinpath(f"{cat}.html"))
+            return []
+        return [latest] if latest else []
+
+    def generate_index(self, out_dir: Path, page: Optional[str], *category_data: List[Dict]):
+        index_data = []
+        for cat, data in zip(self.categories, category_data):
+            if data:
+                index_data.append({**data[0], "category": cat})
+        self.index_data = index_data
+        if self.index_data:     # only if updates needed
+            try:
+                self.generate_index_page(out_dir, self.index_data, page)
+            except Exception as e:
+                self.record_error("index.md", e)
+                self.writer.keep(out_dir.joinpath("index.html"))
+        else:
+            self.writer.keep(out_dir.joinpath("index.html"))
+
+    def generate_tags(self, out_dir: Path, page: Optional[str]):
+        "Generate the tag pages and keep the existing ones if that fails"
+        try:
+            self.generate_tag_pages(out_dir, page)
+        except Exception as e:
+            self.record_error("tag.md", e)
+            self.keep_tag_pages(out_dir)
+
+    def add_page_tasks(self, scheduler: Scheduler, out_dir: Path, categories: Dict[str, List[str]],
+                       pool: Executor, img_pool: Optional[Executor]):
+        """Add the tasks for generating the pages to `scheduler`.
+
+        The assets are copied and the posts and the skeletons of the listing
+        pages are rendered concurrently. Pages are written only after the
+        assets are fingerprinted, as the references to the assets are
+        rewritten when writing, and the listing pages after the posts which
+        they list.
+        """
+        scheduler.add("assets", partial(self.assets_task, "assets", self.copy_assets_dir,
+                                        out_dir))
+        scheduler.add("titles", partial(self.assets_task, "titles", self.load_titles,
+                                        out_dir), ["assets"])
+        assets = scheduler.add("fingerprint", partial(self.assets_task, "fingerprint",
+                                                      self.fingerprint_assets_dir, out_dir),
+                               ["titles"])
+        posts = []
         for fname, fval in self.files_data.items():
-            metadata = fval["metadata"]
-            if "category" in metadata:  # only posts have categories
-                category = metadata["category"]
-                out_file = os.path.join(out_dir, category, fname.replace(".md", ".html"))
-                if fval["update"] or not os.path.exists(out_file):
-                    print_1(f"Generating post {fname}")
-                    page = self.generate_post_page(os.path.join(self.input_dir, fname),
-                                                   metadata)
-                    page = self.add_about(out_dir, page, True)
-                    if self.dry_run:
-                        print_1(f"Not writing post page {fname}.html as dry run")
-                    else:
-                        with open(out_file, "w") as f:
-                            f.write(page)
+            if "category" in fval["metadata"]:  # only posts have categories
+                render = scheduler.add(f"render:post:{fname}",
+                                       partial(self.render_post, out_dir, fname, fval))
+                posts.append(scheduler.add(f"post:{fname}",
+                                           partial(self.write_post, out_dir, fname, fval,
+                                                   pool, img_pool), [assets], [render]))
+        cat_tasks = []
+        for cat, pages in categories.items():
+            render = scheduler.add(f"render:page:{cat}.md", partial(self.render_page, f"{cat}.md"))
+            cat_tasks.append(scheduler.add(f"category:{cat}",
+                                           partial(self.generate_category, out_dir, cat, pages),
+                                           [assets, *(f"post:{p}" for p in pages)], [render]))
+        render = scheduler.add("render:page:index.md", partial(self.render_page, "index.md"))
+        scheduler.add("index", partial(self.generate_index, out_dir), [assets],
+                      [render, *cat_tasks])
+        render = scheduler.add("render:page:tag.md", partial(self.render_page, "tag.md"))
+        scheduler.add("tags", partial(self.generate_tags, out_dir), [assets, *posts], [render])
+
+    def update_related_posts(self):
+        """Find the related posts of each post.
+
+        Each post is represented by the terms in its text, title and tags,
+        which are cached by the hash of the post so that only changed posts
+        are read. Posts whose related posts changed are marked for update.
+        """
+        posts = [fname for fname, fval in self.files_data.items()
+                 if "category" in fval["metadata"]]
+        neighbours: Dict[str, List[str]] = {}
+        if self.related_posts and posts:
+            terms_file = self.state_dir.joinpath("related_terms.json")
+            cached = related.load_terms(terms_file)
+            terms = {}
+            for fname in posts:
+                fval = self.files_data[fname]
+                if fname in cached and cached[fname][0] == fval.get("hash"):
+                    terms[fname] = cached[fname]
+                else:
+                    with open(self.input_dir.joinpath(fname)) as f:
+                        terms[fname] = [fval.get("hash"),
+                                        related.post_terms(f.read(), fval["metadata"])]
+            if terms != cached and not self.dry_run:
+                related.dump_terms(terms_file, terms)
+            neighbours = related.related_posts({k: v[1] for k, v in terms.items()},
+                                               self.related_posts)
+        for fname in posts:
+            fval = self.files_data[fname]
+            if fval.get("related", []) != neighbours.get(fname, []):
+                fval["update"] = True
+            if neighbours.get(fname):
+                fval["related"] = neighbours[fname]
+            else:
+                fval.pop("related", None)
+
+    def related_posts_html(self, fval: Dict) -> str:
+        posts = []
+        for fname in fval.get("related", []):
+            metadata = self.files_data[fname]["metadata"]
+            posts.append({"path": f"../{metadata['category']}/{html_name(fname)}",
+                          "title": metadata.get("title", html_name(fname))})
+        return related_posts_string(posts)
 
     def update_category_and_post_pages(self, out_dir):
-        categories = {}
+        categories: Dict[str, List[str]] = {}
         for fname, fval in self.files_data.items():
             meta = fval["metadata"]
             # page without category is a root page
@@ -270,43 +953,62 @@ class BlogGenerator:
             if not os.path.exists(os.path.join(out_dir, cat)):
                 os.mkdir(os.path.join(out_dir, cat))
             pages.sort(key=lambda x: self.files_data[x]["metadata"]["date"], reverse=True)
-        self.generate_posts(out_dir)
-        index_data = []
-        for cat, pages in categories.items():
-            # - filter by tags may only work with javascript
-            # - page.insert snippet with a <next> for let's say 5-6 results per page
-            # if noscript then show everything (no <next> tags)
-            data = []
-            for i, page in enumerate(pages):
-                temp = {}
-                temp["date"] = self.files_data[page]["metadata"]["date"]
-                tags = self.files_data[page]["metadata"]["tags"]
-                tags = [t.strip().lower() for t in tags.split(",")
-                        if t.strip().lower() not in self.categories]
-                temp["tags"] = [t.replace(" ", "_").lower() for t in tags]
-                html_file = os.path.join(out_dir, cat, page.replace(".md", ".html"))
-                temp["snippet"] = self.get_snippet_content(html_file)
-                temp["path"] = "/".join([cat, page.replace(".md", ".html")])
-                data.append(temp)
-                if not i:       # ignore heading
-                    index_data.append({**temp, "category": cat})
-            print_1(f"Generating category {cat} page")
-            self.generate_category_page(out_dir, cat, data)
-        self.index_data = index_data
+        self.update_related_posts()
+        self.claim_resources(out_dir)
+        # NOTE: The pool is first used from the scheduler's threads and forking
+        #       a process with threads can deadlock, so workers are spawned
+        img_pool = ProcessPoolExecutor(max_workers=self.jobs,
+                                       mp_context=multiprocessing.get_context("spawn"))\
+            if self.image_widths else None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            scheduler = Scheduler(self.jobs)
+            self.add_page_tasks(scheduler, out_dir, categories, pool, img_pool)
+            try:
+                scheduler.run()
+            finally:
+                if img_pool:
+                    img_pool.shutdown()
+        for fname, fval in self.files_data.items():
+            if "category" in fval["metadata"] and fname not in self.errors:
+                fval.pop("failed", None)
+                fval["update"] = False
+
+    def snippet_for(self, out_dir: Path, fname: str) -> SimpleNamespace:
+        """Return the snippet for post `fname`.
+
+        The snippet is stored in the files data so the generated html is
+        parsed only when the post is regenerated. A snippet which wasn't
+        loaded with the files data is read from :attr:`state` and at most
+        :attr:`snippet_cache_size` of those are kept in memory.
+        """
+        fval = self.files_data[fname]
+        snippet = fval.get("snippet")
+        if snippet is None and "snippet" not in fval:
+            snippet = self.snippet_cache.get(fname)
+            if snippet is not None:
+                self.metrics.count("snippet_cache_hits")
+            else:
+                self.metrics.count("snippet_cache_misses")
+                snippet = self.state.load_snippet(fname) if self.state else None
+                if snippet is not None:
+                    self.snippet_cache.put(fname, snippet)
+        if snippet is None:
+            html_file = os.path.join(out_dir, fval["metadata"]["category"],
+                                     html_name(fname))
+            snippet = fval["snippet"] = self.get_snippet_content(html_file).__dict__
+            self.metrics.count("snippets_parsed")
+        return SimpleNamespace(**snippet)
 
     def get_snippet_content(self, html_file: str):
-        if html_file not in self.snippet_cache:
-            with open(html_file) as f:
-                soup = BeautifulSoup(f.read(), features="lxml")
-            heading = soup.find("title").text
-            paras = soup.findAll("p")
-            text: List[str] = []
-            while paras and len(text) <= 70:
-                para = paras.pop(0)
-                text.extend(para.text.split(" "))
-            self.snippet_cache[html_file] = SimpleNamespace(
-                **{"heading": heading, "text": " ".join(text)})
-        return self.snippet_cache[html_file]
+        with open(html_file) as f:
+            soup = BeautifulSoup(f.read(), features="lxml")
+        heading = soup.find("title").text
+        paras = soup.findAll("p")
+        text: List[str] = []
+        while paras and len(text) <= 70:
+            para = paras.pop(0)
+            text.extend(para.text.split(" "))
+        return SimpleNamespace(**{"heading": heading, "text": " ".join(text)})
 
     # NOTE: modify this to change index menu, rest should be similar
     # TODO: This should be generated from a config
@@ -342,7 +1044,9 @@ class BlogGenerator:
         if "img_path" in self.contact:
             img_path = Path(self.contact["img_path"]).absolute()
             out_path = out_dir.joinpath("assets/img/", "photo" + img_path.suffix)
-            shutil.copy(img_path, out_path)
+            if not self.dry_run and out_path not in self.copied_about_imgs:
+                self.writer.copy(img_path, out_path)
+                self.copied_about_imgs.add(out_path)
         else:
             out_path = Path("")
         if self.variables.get("about", None):
@@ -363,77 +1067,78 @@ class BlogGenerator:
     # TODO: I was thinking to use pypandoc, but that calls subprocess anyway
     #       instead of interfacing with haskell libs. Better to write my own
     #       input and output parser for pandoc, similar to pandocwatch
-    def generate_index_page(self, out_dir, data):
+    def generate_index_page(self, out_dir, data, page: Optional[str]):
         print_1(f"Generating index page")
-        p = Popen(f"{self.index_cmd} {self.input_dir}/index.md",
-                  shell=True, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
-        page = out.decode("utf-8")
-        if err:
-            print_1(err)
+        index_path = os.path.join(out_dir, "index.html")
+        if page is None:        # rendering failed
+            self.writer.keep(index_path)
+            return
         menu_string = self.menu_string(self.categories)
         page = page.replace("$INDEX_TOC$", menu_string)
-        index_path = os.path.join(out_dir, "index.html")
-        snippets = []
-        data.sort(key=lambda x: x["date"], reverse=True)
-        for d in data:
-            date = d["date"]
-            tags = d["tags"]
-            tags = " ".join([f"<a class='tag' href='tags/{tag}.html'>{tag}</a>" for tag in tags])
-            path = d["path"]
-            snippet = d["snippet"]
-            category = d["category"]
-            snippets.append(snippet_string_with_category(snippet, path, date, category, tags))
-            # snippets.append(article_snippet_with_category(snippet, path, date, category, tags))
-        page = page.replace("$SNIPPETS$", "\n".join(snippets))
         page = self.add_about(out_dir, page)
         page = self.fix_title("index", page)
-        if self.dry_run:
-            print_1(f"Not writing page {index_path} as dry run")
-        else:
-            with open(index_path, "w") as f:
-                f.write(page)
+
+        def snippets():
+            for d in sorted(data, key=lambda x: x["date"], reverse=True):
+                date = d["date"]
+                tags = d["tags"]
+                tags = " ".join([f"<a class='tag' href='tags/{tag}.html'>{tag}</a>"
+                                 for tag in tags])
+                path = d["path"]
+                snippet = d["snippet"]
+                category = d["category"]
+                yield snippet_string_with_category(snippet, path, date, category, tags)
+                # yield article_snippet_with_category(snippet, path, date, category, tags)
+        self.write_listing_page(index_path, page, snippets())
+
+    def write_listing_page(self, path: Union[str, Path], page: str, snippets: Iterable[str]):
+        """Write listing `page` with `snippets` in place of `$SNIPPETS$`.
+
+        The page is streamed as the part before `$SNIPPETS$`, the snippets as
+        they're generated and the part after it, so that a page with
+        thousands of snippets isn't held in memory.
+        """
+        header, sep, footer = page.partition("$SNIPPETS$")
+        if not sep:
+            self.write_page(path, page)
+            return
+
+        def chunks():
+            yield header
+            for i, snippet in enumerate(snippets):
+                yield "\n" + snippet if i else snippet
+            yield footer
+        self.write_page_stream(path, chunks())
 
     # TODO: JS 5-6 snippets at a time with <next> etc.
-    def generate_category_page(self, out_dir, category, data):
-        p = Popen(f"{self.category_cmd} {self.input_dir}/{category}.md",
-                  shell=True, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
-        page = out.decode("utf-8")
-        if err:
-            print_1(err)
-        if 'not exist' in err.decode("utf-8"):
-            print_1(f"File {category}.md doesn't exist. Cannot continue.")
-            sys.exit(1)
+    def generate_category_page(self, out_dir, category, data, page: Optional[str]):
+        out_file = os.path.join(out_dir, f"{category}.html")
+        if page is None:        # rendering failed
+            self.writer.keep(out_file)
+            return
         # CHECK: Should category menu string differ from index menu string?
         menu_string = self.menu_string(self.categories)
         page = page.replace("$INDEX_TOC$", menu_string)
-        snippets = []
-        for d in data:
-            date = d["date"]
-            tags = d["tags"]
-            tags = " ".join([f"<a class=\"tag\" href='tags/{tag}.html'>{tag}</a>" for tag in tags])
-            path = d["path"]
-            snippet = d["snippet"]
-            snippets.append(snippet_string(snippet, path, date, tags))
-        page = page.replace("$SNIPPETS$", "\n".join(snippets))
         page = self.add_about(out_dir, page)
         page = self.fix_title(category, page)
-        if self.dry_run:
-            print_1(f"Not writing page {category}.html as dry run")
-        else:
-            with open(os.path.join(out_dir, f"{category}.html"), "w") as f:
-                f.write(page)
 
-    def generate_tag_pages(self, out_dir):
+        def snippets():
+            for d in data:
+                date = d["date"]
+                tags = d["tags"]
+                tags = " ".join([f"<a class=\"tag\" href='tags/{tag}.html'>{tag}</a>"
+                                 for tag in tags])
+                path = d["path"]
+                snippet = d["snippet"]
+                yield snippet_string(snippet, path, date, tags)
+        self.write_listing_page(out_file, page, snippets())
+
+    def generate_tag_pages(self, out_dir, page: Optional[str]):
         # TODO: Exclude categories from tags
         tag_pages_dir = os.path.join(out_dir, "tags")
-        p = Popen(f"{self.tag_cmd} {self.input_dir}/tag.md",
-                  shell=True, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
-        page = out.decode("utf-8")
-        if err:
-            print_1(err)
+        if page is None:        # rendering failed
+            self.keep_tag_pages(out_dir)
+            return
         # CHECK: Should category menu string differ from index menu string?
         menu_string = self.menu_string(self.categories, "../")
         page = page.replace("$INDEX_TOC$", menu_string)
@@ -452,26 +1157,32 @@ class BlogGenerator:
                                           fval["metadata"]["date"]])
         if not os.path.exists(tag_pages_dir):
             os.mkdir(tag_pages_dir)
-        for tag, files in all_tags.items():
-            tag_page = page.replace("$TAG$", tag)
-            snippets = []
+        page = self.add_about(out_dir, page, True)
+        page = self.fix_title("index", page, True)
+
+        def snippets(files):
             for fname, category, date in files:
-                _fname = fname.replace(".md", ".html")
-                snippet = self.get_snippet_content(os.path.join(
-                    out_dir, category, fname.replace(".md", ".html")))
+                _fname = html_name(fname)
+                try:
+                    snippet = self.snippet_for(out_dir, fname)
+                except FileNotFoundError:
+                    continue    # post failed and has no earlier output
                 path = f"../{category}/{_fname}"
-                snippets.append(snippet_string_with_category(snippet, path, date, category,
-                                                             cat_path_prefix="../"))
-            tag_page = tag_page.replace("$SNIPPETS$", "\n".join(snippets))
-            tag_page = self.add_about(out_dir, tag_page, True)
-            tag_page = self.fix_title("index", tag_page, True)
-            if self.dry_run:
-                print_1(f"Not writing page {tag}.html as dry run")
-            else:
-                with open(os.path.join(tag_pages_dir, f"{tag}.html"), "w") as f:
-                    f.write(tag_page)
+                yield snippet_string_with_category(snippet, path, date, category,
+                                                   cat_path_prefix="../")
+        for tag, files in all_tags.items():
+            tag_page = page.replace("$TAG$", tag)
+            self.write_listing_page(os.path.join(tag_pages_dir, f"{tag}.html"), tag_page,
+                                    snippets(files))
         self.all_tags = all_tags
 
+    def keep_tag_pages(self, out_dir: Path):
+        tag_pages_dir = os.path.join(out_dir, "tags")
+        if os.path.exists(tag_pages_dir):
+            for tag_file in os.listdir(tag_pages_dir):
+                self.writer.keep(os.path.join(tag_pages_dir, tag_file))
+        self.all_tags = {}
+
     def generate_other_pages(self, out_dir):
         self.generate_about_page(out_dir)
         self.generate_links_page(out_dir)
@@ -486,44 +1197,29 @@ class BlogGenerator:
     def generate_quotes_page(self, out_dir):
         pass
 
-    def cleanup(self, out_dir):
-        """This function:
-            1. Deletes obsolete posts
-            2. Deletes obsolete tag pages
-            3. Deletes obsolete category pages and folders
+    def cleanup(self, out_dir: Path):
+        """Delete obsolete output files.
+
+        The files written or kept in this build are recorded in an output
+        manifest in the state dir. The obsolete files are those which were in
+        the manifest of the previous build but not in this one, so files in
+        `out_dir` which weren't generated by :class:`BlogGenerator` are never
+        touched. Directories left empty are removed.
         """
-        # delete obsolete category folders
-        cat_dirs = [*self.categories, *self.hosted_paths]
-        for o in out_dir.iterdir():
-            if o.is_dir() and o.name not in cat_dirs:
-                if self.dry_run:
-                    print_1(f"NOT deleting obsolete category folder {o} as dry run")
-                else:
-                    print_1(f"Deleting obsolete category folder {o}")
-                    shutil.rmtree(str(o.absolute()))
-            elif (o.is_file() and o.suffix == ".html"
-                  and o.name != "index.html" and o.stem not in cat_dirs):
-                if self.dry_run:
-                    print_1(f"NOT deleting obsolete file {o} as dry run")
-                else:
-                    print_1(f"Deleting obsolete file {o}")
-                    os.remove(o)
         for cat in self.categories:
             # Raise error if some category was not written
-            if not out_dir.joinpath(cat).exists():
+            if not self.dry_run and not out_dir.joinpath(cat).exists():
                 raise FileNotFoundError(out_dir.joinpath(cat))
-            # Delete obsolete posts
-            for out_path in out_dir.joinpath(cat).iterdir():
-                if out_path.stem + ".md" not in self.files_data:
-                    if self.dry_run:
-                        print_1(f"NOT removing obsolete file {out_path} as dry run")
-                    else:
-                        print_1(f"Removing obsolete file {out_path}")
-                        os.remove(out_path)
-        for tag in out_dir.joinpath("tags").iterdir():
-            if tag.stem not in self.all_tags:
-                if self.dry_run:
-                    print_1(f"NOT removing obsolete tag {tag} as dry run")
-                else:
-                    print_1(f"Removing obsolete tag {tag}")
-                    os.remove(tag)
+        manifest_file = outputs_file(self.input_dir, out_dir)
+        previous = load_outputs(manifest_file)
+        current = self.writer.outputs
+        if previous is None:
+            print_1("No previous output manifest. Not removing any files")
+        else:
+            for rel_path in sorted(previous - current):
+                path = out_dir.joinpath(rel_path)
+                if path.exists():
+                    print_1(f"Removing obsolete file {path}")
+                    self.writer.remove(path)
+        if not self.dry_run:
+            dump_outputs(manifest_file, current)
@@ -0,0 +1,101 @@
+from typing import Dict, List
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+
+
+# NOTE: Bump this when derivative generation changes so that cached
+#       derivatives are regenerated
+IMAGES_VERSION = "1"
+image_suffixes = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+_img = re.compile(r"""<img\b[^>]*?\bsrc=(["'])(?P<src>[^"']+)\1[^>]*>""", flags=re.IGNORECASE)
+
+
+def check_pillow():
+    try:
+        import PIL  # noqa
+    except ImportError:
+        raise ImportError("Pillow is required for responsive images. " +
+                          "Install it with 'pip install Pillow'")
+
+
+def is_image(path: str) -> bool:
+    return path.lower().endswith(image_suffixes)
+
+
+def derivative_name(rel_path: str, width: int, fmt: str) -> str:
+    "Return the path of derivative of `rel_path` with `width` and format `fmt`"
+    root, _ = os.path.splitext(rel_path)
+    return f"{root}-{width}w.{fmt}"
+
+
+def image_widths(src: Path, widths: List[int]) -> List[int]:
+    """Return the widths of derivatives for image `src`.
+
+    These are the `widths` smaller than the width of the image and the
+    width of the image itself. Only the image header is read.
+    """
+    from PIL import Image
+    with Image.open(src) as im:
+        width = im.width
+    return [*[w for w in widths if w < width], width]
+
+
+def make_derivatives(src: str, cache_dir: str, widths: List[int], fmt: str,
+                     quality: int) -> Dict[int, str]:
+    """Generate resized derivatives of image `src` in format `fmt`.
+
+    Derivatives are cached in `cache_dir` by hash of the image and the
+    settings so that they are generated only once. Return a dictionary of
+    width to the cached file. This is run in a worker process.
+    """
+    from PIL import Image
+    with open(src, "rb") as f:
+        h = hashlib.sha1(f.read())
+    h.update(json.dumps([widths, fmt, quality, IMAGES_VERSION]).encode("utf-8"))
+    key = h.hexdigest()
+    os.makedirs(cache_dir, exist_ok=True)
+    index_file = os.path.join(cache_dir, key + ".json")
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            result = {int(k): v for k, v in json.load(f).items()}
+        if all(map(os.path.exists, result.values())):
+            return result
+    result = {}
+    with Image.open(src) as im:
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        for width in image_widths(Path(src), widths):
+            out_file = os.path.join(cache_dir, f"{key}-{width}.{fmt}")
+            height = max(1, round(im.height * width / im.width))
+            im.resize((width, height), Image.LANCZOS).save(out_file, quality=quality)
+            result[width] = out_file
+    with open(index_file, "w") as f:
+        json.dump(result, f)
+    return result
+
+
+def add_srcsets(page: str, derivatives: Dict[str, List[int]], fmt: str,
+                sizes: str = "100vw") -> str:
+    """Wrap `<img>` tags in `page` in a `<picture>` with a `srcset` of derivatives.
+
+    Args:
+        page: The html page
+        derivatives: Dictionary of normalized image path to its derivative widths
+        fmt: Format of the derivatives
+        sizes: The `sizes` attribute for the `<source>`
+
+    The original `<img>` is retained as fallback.
+    """
+    def repl(match: re.Match) -> str:
+        src = match.group("src")
+        key = Path(os.path.normpath(src)).as_posix()
+        if key not in derivatives:
+            return match.group(0)
+        srcset = ", ".join(f"{derivative_name(src, w, fmt)} {w}w" for w in derivatives[key])
+        return (f'<picture><source type="image/{fmt}" srcset="{srcset}" sizes="{sizes}">' +
+                match.group(0) + "</picture>")
+    return _img.sub(repl, page)
@@ -0,0 +1,105 @@
+from typing import Dict, List, Optional, Set
+import os
+import re
+import json
+import posixpath
+from pathlib import Path
+
+from .util import print_1, warn_, warn_1
+from .output import atomic_write, outputs_file, load_outputs
+
+
+_link = re.compile(r"""\b(?:href|src)=(["'])([^"']*)\1""", flags=re.IGNORECASE)
+_external = re.compile(r"^(?:[a-zA-Z][a-zA-Z0-9+.-]*:|//)")
+
+
+def links_file(input_dir: Path, out_dir: Path) -> Path:
+    "Return the file in which the index of internal links for `out_dir` is recorded"
+    return input_dir.joinpath(".bloggen", f"links_{out_dir.absolute().name}.json")
+
+
+def internal_links(page: str, rel_path: str) -> List[str]:
+    """Return the internal links in html `page` at `rel_path` in the output directory.
+
+    Links are resolved to paths relative to the output directory and fragments
+    and queries are removed. External links, `mailto:` etc. and links to
+    fragments in the same page are skipped.
+    """
+    links = set()
+    page_dir = posixpath.dirname(rel_path)
+    for _, link in _link.findall(page):
+        link = link.split("#", 1)[0].split("?", 1)[0].strip()
+        if not link or _external.match(link):
+            continue
+        if link.startswith("/"):
+            target = posixpath.normpath(link.lstrip("/"))
+        else:
+            target = posixpath.normpath(posixpath.join(page_dir, link))
+        if link.endswith("/") or target == ".":
+            target = posixpath.normpath(posixpath.join(target, "index.html"))
+        links.add(target)
+    return sorted(links)
+
+
+def load_links(path: Path) -> Dict[str, List[str]]:
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    else:
+        return {}
+
+
+def dump_links(path: Path, links: Dict[str, List[str]]):
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    atomic_write(path, json.dumps(links, indent=0, sort_keys=True).encode("utf-8"))
+
+
+def update_links(previous: Dict[str, List[str]], rendered: Dict[str, List[str]],
+                 outputs: Set[str]) -> Dict[str, List[str]]:
+    """Update the links index `previous` with the links of pages `rendered` in a build.
+
+    Pages which aren't in `outputs` any more are dropped.
+    """
+    links = {k: v for k, v in previous.items() if k in outputs}
+    links.update(rendered)
+    return links
+
+
+def broken_links(links: Dict[str, List[str]], outputs: Set[str],
+                 out_dir: Optional[Path] = None) -> Dict[str, List[str]]:
+    """Return the links in the index `links` whose targets aren't in `outputs`.
+
+    If `out_dir` is given, targets which exist there but weren't generated,
+    like files added by hand, aren't reported.
+    """
+    broken = {}
+    for page, targets in sorted(links.items()):
+        missing = [t for t in targets if t not in outputs and
+                   not (out_dir and os.path.exists(out_dir.joinpath(t)))]
+        if missing:
+            broken[page] = missing
+    return broken
+
+
+def report_broken_links(broken: Dict[str, List[str]]):
+    if not broken:
+        print_1("No broken internal links")
+        return
+    warn_(f"{sum(map(len, broken.values()))} broken internal links in {len(broken)} pages:")
+    for page, targets in broken.items():
+        for target in targets:
+            warn_1(f"{page} -> {target}")
+
+
+def check_links(input_dir: Path, out_dir: Path):
+    """Check the recorded internal links of `out_dir` against its output manifest.
+
+    Nothing is parsed, so this is fast when there's nothing to build.
+    """
+    outputs = load_outputs(outputs_file(input_dir, out_dir))
+    if outputs is None:
+        print_1("No output manifest. Build first to check links")
+        return
+    report_broken_links(broken_links(load_links(links_file(input_dir, out_dir)),
+                                     outputs, out_dir))
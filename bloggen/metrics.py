@@ -0,0 +1,157 @@
+from typing import Any, Dict, Iterator, List, Optional
+import json
+import time
+import threading
+import statistics
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+
+from .util import print_, print_1, warn_, warn_1
+from .output import atomic_write
+
+
+# Caches whose hit rates are computed from the counters `<name>_hits` and `<name>_misses`
+CACHES = ["fragment_cache"]
+
+
+def history_file(input_dir: Path) -> Path:
+    "Return the file in which the metrics of each build are recorded"
+    return input_dir.joinpath(".bloggen", "history.jsonl")
+
+
+def hit_rate(counters: Dict[str, int], cache: str) -> Optional[float]:
+    hits, misses = counters.get(f"{cache}_hits", 0), counters.get(f"{cache}_misses", 0)
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+class BuildMetrics:
+    """Counters and wall times of the phases of a build.
+
+    Counters are incremented with :meth:`count` from any thread and phases
+    are timed with :meth:`phase`. At the end of the build :meth:`record`
+    returns them as a dictionary which is appended to the history file.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.counters: Counter = Counter()
+        self.phases: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def record(self, **extra: Any) -> Dict[str, Any]:
+        """Return the metrics of the build with `extra` fields like the output directory."""
+        counters = dict(sorted(self.counters.items()))
+        return {"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                **extra,
+                "total": round(time.perf_counter() - self.start, 3),
+                "phases": {k: round(v, 3) for k, v in self.phases.items()},
+                "counters": counters,
+                "hit_rates": {x: hit_rate(counters, x) for x in CACHES
+                              if hit_rate(counters, x) is not None}}
+
+
+def append_history(path: Path, record: Dict[str, Any], max_size: int = 1 << 20):
+    """Append `record` to history file `path`.
+
+    If the file is larger than `max_size` bytes, the older half of the
+    records is dropped.
+    """
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+    if path.stat().st_size > max_size:
+        with open(path, "rb") as f:
+            lines = f.readlines()
+        atomic_write(path, b"".join(lines[len(lines) // 2:]))
+
+
+def load_history(path: Path) -> List[Dict[str, Any]]:
+    "Load the records in history file `path`, skipping any malformed lines"
+    history = []
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    continue
+    return history
+
+
+def regressions(history: List[Dict[str, Any]], threshold: float = 0.25,
+                min_time: float = 0.1) -> List[str]:
+    """Compare the last record of `history` with the median of the previous ones.
+
+    Total and phase times more than `threshold` times and `min_time` seconds
+    slower and cache hit rates lower by more than `threshold` are reported.
+    Only builds which rendered pages are compared, as builds with nothing
+    to do are much faster.
+    """
+    builds = [x for x in history if x.get("counters", {}).get("pages_rendered")]
+    if len(builds) < 2:
+        return []
+    *previous, last = builds
+    found = []
+    times = {"total": [x["total"] for x in previous]}
+    for x in previous:
+        for k, v in x.get("phases", {}).items():
+            times.setdefault(k, []).append(v)
+    for name, values in times.items():
+        value = last["total"] if name == "total" else last.get("phases", {}).get(name)
+        if value is None:
+            continue
+        median = statistics.median(values)
+        if value > median * (1 + threshold) and value - median > min_time:
+            found.append(f"{name} took {value:.2f}s, median {median:.2f}s")
+    for cache in CACHES:
+        rates = [x["hit_rates"][cache] for x in previous if cache in x.get("hit_rates", {})]
+        value = last.get("hit_rates", {}).get(cache)
+        if rates and value is not None:
+            median = statistics.median(rates)
+            if value < median - threshold:
+                found.append(f"{cache} hit rate {value:.0%}, median {median:.0%}")
+    return found
+
+
+def report_stats(history: List[Dict[str, Any]], limit: int = 20,
+                 threshold: float = 0.25) -> bool:
+    """Print the last `limit` builds in `history` and any regressions of the last build.
+
+    Return :code:`True` if there are regressions.
+    """
+    if not history:
+        print_("No builds recorded")
+        return False
+    print_(f"{'time':<20}{'output':<12}{'total':>8}{'rendered':>10}{'skipped':>9}" +
+           f"{'pandoc':>8}{'frag hit':>10}{'written':>12}")
+    for x in history[-limit:]:
+        c = x.get("counters", {})
+        rate = x.get("hit_rates", {}).get("fragment_cache")
+        print_(f"{x.get('time', ''):<20}{str(x.get('output', ''))[:11]:<12}" +
+               f"{x.get('total', 0):>7.2f}s{c.get('pages_rendered', 0):>10}" +
+               f"{c.get('pages_skipped', 0):>9}{c.get('pandoc_runs', 0):>8}" +
+               f"{'-' if rate is None else f'{rate:.0%}':>10}{c.get('bytes_written', 0):>12}")
+    found = regressions(history[-limit:], threshold)
+    if found:
+        warn_("Regressions in the last build:")
+        for msg in found:
+            warn_1(msg)
+    else:
+        print_1("No regressions in the last build")
+    return bool(found)
@@ -0,0 +1,219 @@
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+import os
+import re
+import hashlib
+from pathlib import Path
+
+
+# NOTE: Bump this when any of the minifiers change so that the cached assets
+#       are regenerated
+MINIFY_VERSION = "2"
+
+_css_comment = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", flags=re.DOTALL)
+_css_string = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""")
+_css_space = re.compile(r"\s*([{};,>])\s*")
+_css_colon = re.compile(r":\s+")
+_html_comment = re.compile(r"<!--(?!\[if).*?-->", flags=re.DOTALL)
+_html_protected = re.compile(r"(<(pre|textarea|script|style|code)\b.*?</\2\s*>)",
+                             flags=re.DOTALL | re.IGNORECASE)
+_html_style = re.compile(r"(<style\b[^>]*>)(.*?)(</style\s*>)",
+                         flags=re.DOTALL | re.IGNORECASE)
+_whitespace = re.compile(r"\s+")
+# NOTE: Characters after which a `/` starts a regex literal instead of a division
+_js_regex_prefix = "(,=:[!&|?{};+-*%<>~^"
+
+
+def _collapse(match: re.Match) -> str:
+    return "\n" if "\n" in match.group() else " "
+
+
+def minify_css(text: str) -> str:
+    """Remove comments and redundant whitespace from CSS.
+
+    Only whitespace around delimiters where it is never significant is
+    removed, so that selectors like `a :hover` retain their meaning.
+    Quoted strings are left as they are.
+    """
+    text = _css_comment.sub(lambda m: m.group(1) or "", text)
+    parts = _css_string.split(text)
+    # NOTE: split with a group gives [css, string, css, ...]
+    for i in range(0, len(parts), 2):
+        part = _whitespace.sub(" ", parts[i])
+        part = _css_space.sub(r"\1", part)
+        parts[i] = _css_colon.sub(":", part).replace(";}", "}")
+    return "".join(parts).strip()
+
+
+def _js_lines(text: str) -> Iterator[Tuple[str, str, str]]:
+    """Yield each line of JS `text` with the context at its start and end.
+
+    The context is `code`, `comment` inside a block comment or `string`
+    inside a template literal or a string continued on the next line. A
+    regex literal is assumed after an operator or an opening bracket.
+    """
+    # NOTE: Open template literals "`", their substitutions "${", braces "{"
+    #       and block comments "/*"
+    stack: List[str] = []
+    quote = ""
+
+    def context() -> str:
+        if quote or (stack and stack[-1] == "`"):
+            return "string"
+        return "comment" if stack and stack[-1] == "/*" else "code"
+
+    for line in text.splitlines():
+        start = context()
+        prev = ""
+        continued = False
+        i, n = 0, len(line)
+        while i < n:
+            c = line[i]
+            top = stack[-1] if stack else ""
+            if quote:
+                if c == "\\":
+                    continued = i + 1 == n
+                    i += 1
+                elif c == quote:
+                    quote = ""
+            elif top == "/*":
+                if line.startswith("*/", i):
+                    stack.pop()
+                    i += 1
+            elif top == "`":
+                if c == "\\":
+                    i += 1
+                elif c == "`":
+                    stack.pop()
+                    prev = c
+                elif line.startswith("${", i):
+                    stack.append("${")
+                    prev = "{"
+                    i += 1
+            elif line.startswith("//", i):
+                break
+            elif line.startswith("/*", i):
+                stack.append("/*")
+                i += 1
+            elif c in "'\"":
+                quote = c
+            elif c == "`":
+                stack.append("`")
+            elif c == "{":
+                stack.append("{")
+            elif c == "}":
+                if top in ("{", "${"):
+                    stack.pop()
+            elif c == "/" and (not prev or prev in _js_regex_prefix):
+                in_class = False
+                i += 1
+                while i < n and (in_class or line[i] != "/"):
+                    if line[i] == "\\":
+                        i += 1
+                    elif line[i] in "[]":
+                        in_class = line[i] == "["
+                    i += 1
+            if quote or top in ("/*", "`"):
+                pass
+            elif not c.isspace():
+                prev = c
+            i += 1
+        if quote and not continued:
+            quote = ""          # unterminated string
+        yield line, start, context()
+
+
+def minify_js(text: str) -> str:
+    """Conservatively minify JS.
+
+    Lines are stripped, blank lines and full line `//` comments are
+    dropped. Lines in template literals and multi-line strings are left as
+    they are. Lines are never joined as that may break automatic semicolon
+    insertion.
+    """
+    lines = []
+    for line, start, end in _js_lines(text):
+        if start != "string":
+            line = line.lstrip()
+            if start == "code" and line.startswith("//"):
+                continue
+        if end != "string":
+            line = line.rstrip()
+        if line or start == "string" or end == "string":
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def minify_html(text: str, strip: bool = True) -> str:
+    """Remove comments and collapse whitespace in HTML.
+
+    Contents of `pre`, `textarea`, `script` and `code` tags are left as they
+    are. Inline `style` tags are minified as CSS. If `strip` is false, the
+    whitespace at the ends is collapsed but kept, as for parts of a page.
+    """
+    text = _html_comment.sub("", text)
+    parts = _html_protected.split(text)
+    result = []
+    # NOTE: split with two groups gives [text, block, tag_name, text, ...]
+    for i in range(0, len(parts), 3):
+        result.append(_whitespace.sub(_collapse, parts[i]))
+        if i + 1 < len(parts):
+            block = parts[i + 1]
+            if parts[i + 2].lower() == "style":
+                block = _html_style.sub(lambda m: m.group(1) + minify_css(m.group(2))
+                                        + m.group(3), block)
+            result.append(block)
+    return "".join(result).strip() if strip else "".join(result)
+
+
+minifiers: Dict[str, Callable[[str], str]] = {".css": minify_css,
+                                              ".js": minify_js,
+                                              ".html": minify_html}
+
+
+def minifier_for(path: Path) -> Optional[Callable[[str], str]]:
+    """Return the minifier for `path` or :code:`None`
+
+    Files which are already minified (like `*.min.js`) are skipped.
+    """
+    if path.name.endswith((".min.css", ".min.js")):
+        return None
+    return minifiers.get(path.suffix)
+
+
+def minify_cached(path: Path, cache_dir: Path,
+                  used: Optional[Set[str]] = None) -> Optional[bytes]:
+    """Return the minified contents of `path` or :code:`None` if it cannot be minified.
+
+    The minified output is cached in `cache_dir` by hash of the content so
+    that unchanged assets are never minified again. The name of the cache
+    file is added to `used` if given, for :func:`prune_minify_cache`.
+    """
+    func = minifier_for(path)
+    if func is None:
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha1(data + MINIFY_VERSION.encode("utf-8")).hexdigest()
+    cache_file = cache_dir.joinpath(digest + path.suffix)
+    if used is not None:
+        used.add(cache_file.name)
+    if cache_file.exists():
+        with open(cache_file, "rb") as f:
+            return f.read()
+    minified = func(data.decode("utf-8")).encode("utf-8")
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True)
+    with open(cache_file, "wb") as f:
+        f.write(minified)
+    return minified
+
+
+def prune_minify_cache(cache_dir: Path, used: Set[str]) -> int:
+    "Remove the files in `cache_dir` not in `used` and return the number removed"
+    removed = 0
+    if cache_dir.exists():
+        for fname in os.listdir(cache_dir):
+            if fname not in used:
+                os.remove(cache_dir.joinpath(fname))
+                removed += 1
+    return removed
@@ -0,0 +1,262 @@
+from typing import Dict, Iterable, List, Optional, Set, Union
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+
+from .util import print_1
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def replace_file(tmp: str, path: Union[str, Path]):
+    "Rename `tmp` to `path` keeping the permissions of existing `path`"
+    if os.path.exists(path):
+        os.chmod(tmp, os.stat(path).st_mode & 0o777)
+    else:
+        os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def atomic_write(path: Union[str, Path], data: bytes):
+    "Write `data` to a temporary file in the same directory and rename it to `path`"
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".bloggen-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        replace_file(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class OutputWriter:
+    """Write files in the output directory only if their content differs.
+
+    Existing files are compared by size and then by hash, writes are atomic
+    and the paths which were added, modified or deleted are recorded so that
+    a manifest of changed files can be used for deploying only the changes.
+
+    Args:
+        out_dir: The output directory. Paths are recorded relative to it.
+        dry_run: Only record the changes, don't write anything
+
+    The writer can be used from multiple threads.
+
+    """
+    def __init__(self, out_dir: Path, dry_run: bool = False):
+        self.out_dir = out_dir
+        self.dry_run = dry_run
+        self.added: Set[str] = set()
+        self.modified: Set[str] = set()
+        self.unchanged: Set[str] = set()
+        self.deleted: Set[str] = set()
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def rel_path(self, path: Union[str, Path]) -> str:
+        return Path(os.path.relpath(path, self.out_dir)).as_posix()
+
+    @property
+    def changed(self) -> List[str]:
+        return sorted(self.added | self.modified)
+
+    @property
+    def outputs(self) -> Set[str]:
+        "All the files which were written or kept in this build"
+        return self.added | self.modified | self.unchanged
+
+    def keep(self, path: Union[str, Path]):
+        "Record an existing output file `path` which wasn't regenerated in this build"
+        if os.path.exists(path):
+            with self.lock:
+                self.unchanged.add(self.rel_path(path))
+
+    def _record(self, path: Union[str, Path], size: int, digest: str) -> bool:
+        rel_path = self.rel_path(path)
+        if os.path.exists(path):
+            if os.stat(path).st_size == size and file_digest(path) == digest:
+                with self.lock:
+                    self.unchanged.add(rel_path)
+                return False
+            with self.lock:
+                if rel_path not in self.added:
+                    self.modified.add(rel_path)
+        else:
+            with self.lock:
+                self.added.add(rel_path)
+        with self.lock:
+            self.deleted.discard(rel_path)
+            self.bytes_written += size
+        return True
+
+    def write(self, path: Union[str, Path], content: Union[str, bytes]) -> bool:
+        """Write `content` to `path` if it differs from the existing file.
+
+        Return :code:`True` if the file was (or in case of dry run would be) written.
+        """
+        data = content.encode("utf-8") if isinstance(content, str) else content
+        if not self._record(path, len(data), hashlib.sha1(data).hexdigest()):
+            return False
+        if self.dry_run:
+            print_1(f"Not writing {self.rel_path(path)} as dry run")
+        else:
+            atomic_write(path, data)
+        return True
+
+    def write_stream(self, path: Union[str, Path], chunks: Iterable[Union[str, bytes]]) -> bool:
+        """Write `chunks` to `path` if the content differs from the existing file.
+
+        The chunks are written to a temporary file as they're generated, so
+        the whole content is never held in memory, and the temporary file
+        replaces `path` only if the content differs.
+
+        Return :code:`True` if the file was (or in case of dry run would be) written.
+        """
+        h = hashlib.sha1()
+        size = 0
+        tmp = None
+        try:
+            if self.dry_run:
+                f = None
+            else:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                           prefix=".bloggen-")
+                f = os.fdopen(fd, "wb")
+            try:
+                for chunk in chunks:
+                    data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                    h.update(data)
+                    size += len(data)
+                    if f:
+                        f.write(data)
+            finally:
+                if f:
+                    f.close()
+            if not self._record(path, size, h.hexdigest()):
+                return False
+            if self.dry_run:
+                print_1(f"Not writing {self.rel_path(path)} as dry run")
+            else:
+                replace_file(tmp, path)     # type: ignore
+                tmp = None
+            return True
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def copy(self, src: Union[str, Path], dest: Union[str, Path]) -> bool:
+        """Copy `src` to `dest` if the contents differ.
+
+        Return :code:`True` if the file was (or in case of dry run would be) copied.
+        """
+        with open(src, "rb") as f:
+            return self.write(dest, f.read())
+
+    def remove(self, path: Union[str, Path]):
+        "Remove the file or directory `path` and record the files removed"
+        with self.lock:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for fname in files:
+                        self.deleted.add(self.rel_path(os.path.join(root, fname)))
+            else:
+                self.deleted.add(self.rel_path(path))
+        if self.dry_run:
+            print_1(f"Not removing {self.rel_path(path)} as dry run")
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+            prune_empty_dirs(self.out_dir, Path(path))
+
+    def changes(self) -> Dict[str, List[str]]:
+        return {"added": sorted(self.added), "modified": sorted(self.modified),
+                "deleted": sorted(self.deleted - self.added - self.modified)}
+
+    def dump_changes(self, path: Path):
+        """Merge the changes of this build into the pending changes at `path`.
+
+        The pending changes accumulate over builds until they are applied
+        with `bloggen sync`.
+        """
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        changes = merge_changes(load_changes(path), self.changes())
+        atomic_write(path, json.dumps(changes, indent=1).encode("utf-8"))
+
+
+def prune_empty_dirs(root: Path, path: Path):
+    "Remove the empty parent directories of `path` up to `root`"
+    parent = path.parent
+    while parent != root and parent.exists() and not any(parent.iterdir()):
+        parent.rmdir()
+        parent = parent.parent
+
+
+def outputs_file(input_dir: Path, out_dir: Path) -> Path:
+    "Return the file in which the output manifest for `out_dir` is recorded"
+    return input_dir.joinpath(".bloggen", f"outputs_{out_dir.absolute().name}.json")
+
+
+def load_outputs(path: Path) -> Optional[Set[str]]:
+    if path.exists():
+        with open(path) as f:
+            return set(json.load(f))
+    else:
+        return None
+
+
+def dump_outputs(path: Path, outputs: Set[str]):
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    atomic_write(path, json.dumps(sorted(outputs), indent=0).encode("utf-8"))
+
+
+def changes_file(input_dir: Path, out_dir: Path) -> Path:
+    "Return the file in which the pending changes for `out_dir` are recorded"
+    return input_dir.joinpath(".bloggen", f"changes_{out_dir.absolute().name}.json")
+
+
+def load_changes(path: Path) -> Dict[str, List[str]]:
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    else:
+        return {"added": [], "modified": [], "deleted": []}
+
+
+def merge_changes(old: Dict[str, List[str]], new: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Merge changes `new` of a build into earlier pending changes `old`.
+
+    A file added and later deleted before a sync is dropped and a file which
+    is written again after being deleted is marked modified.
+    """
+    added, modified, deleted = (set(old.get(k, [])) for k in ["added", "modified", "deleted"])
+    for p in new["added"]:
+        if p in deleted:
+            deleted.discard(p)
+            modified.add(p)
+        elif p not in modified:
+            added.add(p)
+    for p in new["modified"]:
+        if p not in added:
+            modified.add(p)
+    for p in new["deleted"]:
+        if p in added:
+            added.discard(p)
+        else:
+            modified.discard(p)
+            deleted.add(p)
+    return {"added": sorted(added), "modified": sorted(modified), "deleted": sorted(deleted)}
@@ -0,0 +1,110 @@
+from typing import Any, Dict, List
+import re
+import json
+import math
+from pathlib import Path
+from collections import Counter
+
+from .output import atomic_write
+
+
+# NOTE: Bump this when the terms extracted from posts change so that the
+#       cached terms are extracted again
+RELATED_VERSION = "1"
+
+_front_matter = re.compile(r"\A---\s*\n.*?\n(?:---|\.\.\.)\s*\n", flags=re.DOTALL)
+_word = re.compile(r"[a-z][a-z0-9'-]{2,}")
+_stopwords = frozenset("""about after all also and any are because been before being between
+both but can could did does each for from had has have her here him his how into its just
+more most not now off once only other our out over own same she should some such than that
+the their them then there these they this those through too under until very was were what
+when where which while who whom why will with would you your""".split())
+
+
+def check_numpy():
+    try:
+        import numpy  # noqa
+        import scipy.sparse  # noqa
+    except ImportError:
+        raise ImportError("NumPy and SciPy are required for related posts. " +
+                          "Install them with 'pip install numpy scipy'")
+
+
+def words(text: str) -> List[str]:
+    return [w for w in _word.findall(text.lower()) if w not in _stopwords]
+
+
+def post_terms(text: str, metadata: Dict[str, Any]) -> Dict[str, int]:
+    """Return the counts of terms in markdown `text` of a post with `metadata`.
+
+    Words of the title are counted twice and the tags, prefixed with `#`,
+    thrice so that they weigh more than the words in the text.
+    """
+    counts = Counter(words(_front_matter.sub("", text)))
+    for word in words(str(metadata.get("title", ""))):
+        counts[word] += 2
+    for tag in str(metadata.get("tags", "")).split(","):
+        if tag.strip():
+            counts["#" + tag.strip().replace(" ", "_").lower()] += 3
+    return dict(counts)
+
+
+def load_terms(path: Path) -> Dict[str, List]:
+    "Load the cached terms of posts, a dictionary of post to its hash and terms"
+    if path.exists():
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") == RELATED_VERSION:
+            return data["posts"]
+    return {}
+
+
+def dump_terms(path: Path, terms: Dict[str, List]):
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    atomic_write(path, json.dumps({"version": RELATED_VERSION, "posts": terms})
+                 .encode("utf-8"))
+
+
+def related_posts(terms: Dict[str, Dict[str, int]], k: int,
+                  batch_size: int = 256) -> Dict[str, List[str]]:
+    """Return the `k` most similar posts of each post.
+
+    Each post is a sparse TF-IDF vector of its `terms` and the similarity is
+    the cosine of the vectors. The similarities are computed for
+    `batch_size` posts at a time as a sparse matrix product. Posts with no
+    terms in common aren't related and ties are broken by the order of
+    `terms`.
+
+    Args:
+        terms: Dictionary of post to counts of its terms
+        k: Number of related posts for each post
+        batch_size: Number of posts for which to compute similarities at a time
+
+    """
+    import numpy as np
+    from scipy import sparse
+    names = [*terms]
+    vocab: Dict[str, int] = {}
+    rows, cols, vals = [], [], []
+    for i, name in enumerate(names):
+        for term, count in terms[name].items():
+            rows.append(i)
+            cols.append(vocab.setdefault(term, len(vocab)))
+            vals.append(1 + math.log(count))
+    n = len(names)
+    X = sparse.csr_matrix((vals, (rows, cols)), shape=(n, len(vocab)))
+    df = np.bincount(np.asarray(cols, dtype=np.int64), minlength=len(vocab))
+    X = X @ sparse.diags(np.log((1 + n) / (1 + df)) + 1)
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    X = (sparse.diags(1 / norms) @ X).tocsr()
+    related = {}
+    for start in range(0, n, batch_size):
+        sims = (X[start:start + batch_size] @ X.T).toarray()
+        idx = np.arange(sims.shape[0])
+        sims[idx, start + idx] = -1
+        order = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+        for i, row in enumerate(order):
+            related[names[start + i]] = [names[j] for j in row if sims[i, j] > 0]
+    return related
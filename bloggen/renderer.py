@@ -0,0 +1,348 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+import os
+import re
+import json
+import shlex
+import asyncio
+import hashlib
+import tempfile
+from pathlib import Path
+from subprocess import PIPE
+
+from .util import find_bibliographies, replace_metadata, print_1, BuildError
+from .template import Template
+
+
+_front_matter = re.compile(r"\A---\s*\n.*?\n(?:---|\.\.\.)\s*\n", flags=re.DOTALL)
+_tags = re.compile(r"<[^>]+>")
+_math = re.compile(r"\$\$|\\\(|\\\[|(?<![\\$])\$[^\s$][^$\n]*(?<![\s\\])\$(?!\d)")
+# NOTE: Pandoc markdown extensions which markdown-it doesn't have. Footnotes and
+#       inline notes, attributes of headers, code blocks, links and spans,
+#       definition lists and table captions, fenced divs, simple and grid
+#       tables and sub and superscripts
+_pandoc_only = re.compile(r"\[\^[^\]\s]+\]|\^\[|\{\s*[#.=][^}\n]*\}|[)\]]\{[^}\n]*\}|"
+                          r"^ {0,3}[:~][ \t]+\S|^:::|^ {0,3}-{2,}(?: +-{2,})+ *$|"
+                          r"^\+(?:[-=:]+\+)+ *$|"
+                          r"(?<!~)~[^~\s]+~(?!~)|\^[^^\s\[]+\^", flags=re.MULTILINE)
+
+
+async def run_pandoc_async(cmd: str, in_file: Union[str, Path]) -> str:
+    """Run pandoc command `cmd` on `in_file` as an asyncio subprocess and return the output.
+
+    The command isn't run through the shell. Raise :class:`BuildError` if
+    pandoc fails.
+    """
+    p = await asyncio.create_subprocess_exec(*shlex.split(cmd), str(in_file),
+                                             stdout=PIPE, stderr=PIPE)
+    out, err = await p.communicate()
+    if p.returncode:
+        raise BuildError(f"pandoc failed for {in_file}: {err.decode('utf-8').strip()}")
+    if err:
+        print_1(err.decode("utf-8"))
+    return out.decode("utf-8")
+
+
+Fragment = Dict[str, Any]
+
+
+def fill_template(template: Template, fragment: Fragment, templates_dir: Path,
+                  toc: bool = False) -> str:
+    """Fill `template` with a rendered `fragment`.
+
+    The context is the rendered metadata along with `body`, `pagetitle`,
+    `templates_dir`, the variables `highlighting-css`, `math` and
+    `header-includes` if pandoc set them and if `toc` then `toc` and
+    `table-of-contents`, similar to what pandoc provides.
+    """
+    context = {**fragment["meta"]}
+    for key in ["title", "author", "date"]:
+        if key in context:
+            context[f"{key}-meta"] = _tags.sub("", Template.stringify(context[key]))
+    if "title" in context:
+        context["pagetitle"] = context["title-meta"]
+    context.update({k: v for k, v in fragment.get("vars", {}).items() if v})
+    context.update({"body": fragment["body"], "templates_dir": str(templates_dir)})
+    if toc and fragment["toc"]:
+        context["toc"] = context["table-of-contents"] = fragment["toc"]
+    return template.render(context)
+
+
+class Renderer:
+    """Base class for renderers which convert a markdown file to an html fragment.
+
+    The fragment is a dictionary with the `body`, the table of contents `toc`
+    and the rendered metadata `meta`, which is then used to fill a template
+    with :func:`fill_template`. As the fragment doesn't depend on the
+    templates, it can be cached and the templates can be refilled without
+    rendering again.
+
+    Args:
+        templates_dir: Directory with the templates
+
+    """
+    name = ""
+
+    def __init__(self, templates_dir: Path):
+        self.templates_dir = templates_dir
+
+    @property
+    def options(self) -> str:
+        "Options which affect the output, used for cache keys"
+        return ""
+
+    async def render_fragment(self, in_file: Path, metadata: Dict[str, Any]) -> Fragment:
+        """Render `in_file` to an html fragment from an asyncio event loop.
+
+        Args:
+            in_file: The markdown file
+            metadata: Metadata of the file
+
+        """
+        raise NotImplementedError
+
+
+# NOTE: Sections of the output of pandoc with the fragment template. The body
+#       must be the last as it can contain anything.
+_sections = [("META", "$meta-json$"), ("TOC", "$table-of-contents$"),
+             ("HIGHLIGHTING-CSS", "$highlighting-css$"), ("MATH", "$math$"),
+             ("HEADER-INCLUDES", "$for(header-includes)$\n$header-includes$\n$endfor$"),
+             ("BODY", "$body$")]
+_fragment_template = "\n".join(f"<!--BLOGGEN:{name}-->\n{var}" for name, var in _sections)
+_section_marker = re.compile(r"<!--BLOGGEN:([A-Z-]+)-->\n?")
+_fragment_vars = ["highlighting-css", "math", "header-includes"]
+
+
+def fragment_template_file(directory: Path) -> Path:
+    """Return a template file in `directory` for pandoc which outputs the fragment.
+
+    That is the metadata, the toc, the variables in :data:`_fragment_vars`
+    and the body.
+    """
+    digest = hashlib.sha1(_fragment_template.encode("utf-8")).hexdigest()[:10]
+    path = directory.joinpath(f"fragment-{digest}.template")
+    if not path.exists():
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".bloggen-")
+        with os.fdopen(fd, "w") as f:
+            f.write(_fragment_template)
+        os.replace(tmp, path)
+    return path
+
+
+def parse_fragment(output: str) -> Fragment:
+    "Parse the output of pandoc with the fragment template"
+    if "<!--BLOGGEN:BODY-->" not in output:
+        raise BuildError("Unexpected output of pandoc with the fragment template")
+    # NOTE: The body is split off first as it may contain anything
+    head, body = output.split("<!--BLOGGEN:BODY-->", 1)
+    parts = _section_marker.split(head)
+    sections = {name.lower(): text for name, text in zip(parts[1::2], parts[2::2])}
+    if "meta" not in sections:
+        raise BuildError("Unexpected output of pandoc with the fragment template")
+    return {"meta": json.loads(sections["meta"]), "toc": sections.get("toc", "").strip(),
+            "vars": {x: sections.get(x, "").strip() for x in _fragment_vars},
+            "body": body.strip("\n")}
+
+
+class PandocRenderer(Renderer):
+    """Render with the pandoc executable.
+
+    Pandoc is run with a template which outputs only the metadata as JSON,
+    the table of contents and the body.
+
+    Args:
+        templates_dir: Directory with the templates
+        cmd: Pandoc command without template options
+        bib_dirs: Directories to search for bibliographies
+        options: Options in `cmd` which affect the output, without paths.
+                 Used for cache keys. Defaults to `cmd`
+        fragment_dir: Directory in which the fragment template is written.
+                      Defaults to a new temporary directory.
+
+    """
+    name = "pandoc"
+
+    def __init__(self, templates_dir: Path, cmd: str, bib_dirs: List[str],
+                 options: Optional[str] = None, fragment_dir: Optional[Path] = None):
+        super().__init__(templates_dir)
+        self.cmd = cmd
+        self.bib_dirs = bib_dirs
+        self._options = cmd if options is None else options
+        fragment_dir = fragment_dir or Path(tempfile.mkdtemp(prefix="bloggen-"))
+        template = shlex.quote(f"--template={fragment_template_file(fragment_dir)}")
+        self.fragment_cmd = " ".join([cmd, template, "--toc"])
+
+    @property
+    def options(self) -> str:
+        return " ".join([self._options, _fragment_template])
+
+    async def render_fragment(self, in_file: Path, metadata: Dict[str, Any]) -> Fragment:
+        if "bibliography" in metadata:
+            loop = asyncio.get_running_loop()
+            tp = await loop.run_in_executor(None, self.with_bibliographies, in_file, metadata)
+            with tp:
+                return parse_fragment(await run_pandoc_async(self.fragment_cmd, tp.name))
+        else:
+            return parse_fragment(await run_pandoc_async(self.fragment_cmd, in_file))
+
+    def with_bibliographies(self, in_file: Path, metadata: Dict[str, Any]):
+        """Return a temporary copy of `in_file` with paths of the bibliographies.
+
+        The bibliographies are searched in :attr:`bib_dirs`.
+        """
+        bib_files = find_bibliographies(metadata["bibliography"], self.bib_dirs)
+        tp = tempfile.NamedTemporaryFile(mode="r+", prefix="bloggen-")
+        with open(in_file) as pf:
+            post = pf.read()
+        tp.write(replace_metadata(post, {**metadata, "bibliography": bib_files}))
+        tp.flush()
+        return tp
+
+
+def slugify(text: str, used: Dict[str, int]) -> str:
+    "Return a pandoc style identifier for heading `text` unique among `used`"
+    slug = re.sub(r"[^\w\s.-]", "", text.lower()).strip()
+    slug = re.sub(r"\s+", "-", slug)
+    slug = re.sub(r"^[^a-z]+", "", slug) or "section"
+    if slug in used:
+        used[slug] += 1
+        return f"{slug}-{used[slug]}"
+    used[slug] = 0
+    return slug
+
+
+_smart_punctuation = {"---": "\u2014", "--": "\u2013", "...": "\u2026"}
+
+
+def pandoc_inline(state) -> None:
+    """Make inline elements like pandoc renders them.
+
+    Strikeout is rendered as `<del>` and dashes and ellipses in text are
+    replaced like the `smart` extension. Unlike the `replacements` rule of
+    markdown-it, things like `(c)` are left as they are.
+    """
+    for token in state.tokens:
+        for child in token.children or []:
+            if child.type == "text":
+                child.content = re.sub(r"-{2,3}|\.\.\.",
+                                       lambda m: _smart_punctuation[m.group()], child.content)
+            elif child.type in ("s_open", "s_close"):
+                child.tag = "del"
+
+
+class MarkdownRenderer(Renderer):
+    """Render in process with `markdown-it-py <https://github.com/executablebooks/markdown-it-py>`_.
+
+    Raw html, pipe tables, strikeout and smart quotes, dashes and ellipses
+    are enabled, similar to the pandoc extensions used. Headings get pandoc
+    style identifiers.
+
+    Doesn't support citations, math and other pandoc extensions like
+    footnotes, for which :class:`PandocRenderer` should be used. See
+    :func:`needs_pandoc`.
+
+    Args:
+        templates_dir: Directory with the templates
+
+    """
+    name = "markdown"
+
+    def __init__(self, templates_dir: Path):
+        super().__init__(templates_dir)
+        try:
+            from markdown_it import MarkdownIt
+        except ImportError:
+            raise ImportError("markdown-it-py is required for the markdown renderer. " +
+                              "Install it with 'pip install markdown-it-py'")
+        self.md = MarkdownIt("commonmark", {"html": True, "typographer": True})\
+            .enable(["table", "strikethrough", "smartquotes"])
+        self.md.core.ruler.push("pandoc_inline", pandoc_inline)
+
+    @property
+    def options(self) -> str:
+        from markdown_it import __version__
+        return f"markdown-it-py {__version__} commonmark html table strikethrough smart"
+
+    def render_body(self, text: str) -> Tuple[str, str]:
+        "Return the html body and the table of contents for markdown `text`"
+        tokens = self.md.parse(_front_matter.sub("", text))
+        used: Dict[str, int] = {}
+        headings = []
+        for i, token in enumerate(tokens):
+            if token.type == "heading_open":
+                title = tokens[i + 1].content
+                ident = slugify(title, used)
+                token.attrSet("id", ident)
+                headings.append((int(token.tag[1]), ident, self.md.renderInline(title).strip()))
+        body = self.md.renderer.render(tokens, self.md.options, {})
+        return body, self.toc_html(headings)
+
+    @staticmethod
+    def toc_html(headings: List[Tuple[int, str, str]]) -> str:
+        if not headings:
+            return ""
+        html = []
+        levels: List[int] = []
+        for level, ident, title in headings:
+            if levels and level <= levels[-1]:
+                while levels and level < levels[-1]:
+                    html.append("</li>\n</ul>")
+                    levels.pop()
+                html.append("</li>")
+            if not levels or level > levels[-1]:
+                html.append("<ul>")
+                levels.append(level)
+            html.append(f'<li><a href="#{ident}" id="toc-{ident}">{title}</a>')
+        html.extend(["</li>\n</ul>"] * len(levels))
+        return "\n".join(html)
+
+    def metadata_value(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return self.md.renderInline(value)
+        elif isinstance(value, list):
+            return [self.metadata_value(v) for v in value]
+        elif isinstance(value, dict):
+            return {k: self.metadata_value(v) for k, v in value.items()}
+        else:
+            return value
+
+    def render_file(self, in_file: Path, metadata: Dict[str, Any]) -> Fragment:
+        with open(in_file) as f:
+            body, toc = self.render_body(f.read())
+        return {"meta": {k: self.metadata_value(v) for k, v in metadata.items()},
+                "toc": toc, "body": body}
+
+    async def render_fragment(self, in_file: Path, metadata: Dict[str, Any]) -> Fragment:
+        "Render in a thread so that other posts and pandoc aren't blocked"
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.render_file, in_file, metadata)
+
+
+def needs_pandoc(in_file: Path, metadata: Dict[str, Any]) -> bool:
+    """Check if `in_file` requires pandoc.
+
+    That is if it has a bibliography, math or any pandoc extension which
+    :class:`MarkdownRenderer` doesn't support like footnotes, header
+    attributes, definition lists or simple tables, or if `renderer: pandoc`
+    is set in its metadata. The check errs on the side of pandoc.
+    """
+    if metadata.get("renderer"):
+        return metadata["renderer"] == "pandoc"
+    if "bibliography" in metadata:
+        return True
+    with open(in_file) as f:
+        text = _front_matter.sub("", f.read())
+    return bool(_math.search(text) or _pandoc_only.search(text))
+
+
+def choose_renderer(mode: str, in_file: Path, metadata: Dict[str, Any],
+                    pandoc: Renderer, markdown: Optional[Renderer]) -> Renderer:
+    """Choose the renderer for `in_file` according to `mode`.
+
+    With mode `auto`, `markdown` is used unless the file :func:`needs_pandoc`.
+    """
+    if markdown is None or mode == "pandoc":
+        return pandoc
+    if mode == "markdown" and metadata.get("renderer") != "pandoc":
+        return markdown
+    return pandoc if needs_pandoc(in_file, metadata) else markdown
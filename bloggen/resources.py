@@ -0,0 +1,56 @@
+from typing import Dict
+import os
+import re
+from pathlib import Path
+
+
+_link = re.compile(r"""(?:src|href)=["']([^"'#?]+)[^"']*["']""")
+_skip_suffixes = (".html", ".htm", ".md")
+
+
+def sibling_resources(post_file: Path) -> Dict[str, Path]:
+    """Return the files in the directory with the same name as `post_file` beside it.
+
+    For example, for `my-post.md`, files in `my-post/`. The keys are paths
+    relative to the parent of `post_file`.
+    """
+    res_dir = post_file.parent.joinpath(post_file.stem)
+    resources = {}
+    if res_dir.is_dir():
+        for root, dirs, files in os.walk(res_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for fname in files:
+                path = Path(root).joinpath(fname)
+                resources[path.relative_to(post_file.parent).as_posix()] = path
+    return resources
+
+
+def linked_resources(post_file: Path, page: str) -> Dict[str, Path]:
+    """Return the local files linked relatively in the generated html `page`.
+
+    Only links which resolve to existing files relative to the directory of
+    `post_file` and don't go above it are included.
+    """
+    resources = {}
+    for link in set(_link.findall(page)):
+        if "://" in link or link.startswith(("/", "mailto:", "data:", "javascript:")) or\
+           link.endswith(_skip_suffixes):
+            continue
+        rel_path = os.path.normpath(link)
+        if rel_path.startswith(".."):
+            continue
+        path = post_file.parent.joinpath(rel_path)
+        if path.is_file():
+            resources[Path(rel_path).as_posix()] = path
+    return resources
+
+
+def find_resources(post_file: Path, page: str) -> Dict[str, Path]:
+    """Return the resources of a post like images and attachments.
+
+    These are the files in a sibling directory with the name of the post and
+    the local files linked relatively from the generated `page`. The keys are
+    the paths relative to the post, which are also the paths relative to
+    the generated html file.
+    """
+    return {**sibling_resources(post_file), **linked_resources(post_file, page)}
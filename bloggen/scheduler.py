@@ -0,0 +1,73 @@
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Scheduler:
+    """Run a DAG of build tasks with asyncio.
+
+    Each task is a function which is called once its dependencies are done,
+    with the results of the dependencies given as its `inputs` as arguments.
+    Coroutine functions are awaited in the event loop, so that they can wait
+    for subprocesses like pandoc, and other functions are run in a thread
+    pool as they mostly do file I/O.
+
+    At most `jobs` tasks run at a time. Tasks must be added after their
+    dependencies, which ensures that there are no cycles, and the results
+    don't depend on the order in which tasks finish.
+
+    Args:
+        jobs: Maximum number of tasks to run at a time
+
+    """
+    def __init__(self, jobs: int):
+        self.jobs = max(1, jobs)
+        self.tasks: Dict[str, Tuple[Callable, List[str], List[str]]] = {}
+
+    def add(self, name: str, func: Callable, deps: Iterable[str] = (),
+            inputs: Iterable[str] = ()) -> str:
+        """Add task `name` which runs `func` after the tasks `deps` and `inputs`.
+
+        `func` is called with the results of `inputs`. Return the name of the task.
+        """
+        deps, inputs = [*deps], [*inputs]
+        if name in self.tasks:
+            raise ValueError(f"Task {name} already exists")
+        for dep in [*deps, *inputs]:
+            if dep not in self.tasks:
+                raise ValueError(f"Unknown dependency {dep} of task {name}")
+        self.tasks[name] = (func, deps, inputs)
+        return name
+
+    def run(self) -> Dict[str, Any]:
+        """Run all the tasks and return their results by name.
+
+        If any tasks fail, their dependents fail too and the exception of
+        the first failed task in the order they were added is raised after
+        the others are done.
+        """
+        return asyncio.run(self._run())
+
+    async def _run(self) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.jobs)
+        futures: Dict[str, asyncio.Future] = {}
+
+        async def run_task(func: Callable, deps: List[str], inputs: List[str]) -> Any:
+            for dep in deps:
+                await futures[dep]
+            args = [await futures[dep] for dep in inputs]
+            async with limit:
+                if asyncio.iscoroutinefunction(func):
+                    return await func(*args)
+                else:
+                    return await loop.run_in_executor(pool, func, *args)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for name, (func, deps, inputs) in self.tasks.items():
+                futures[name] = asyncio.ensure_future(run_task(func, deps, inputs))
+            results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return dict(zip(futures, results))
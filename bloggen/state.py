@@ -0,0 +1,257 @@
+from typing import Any, Dict, Optional, Tuple
+import os
+import json
+import sqlite3
+import threading
+import datetime
+from pathlib import Path
+
+from .util import print_1
+from .output import atomic_write
+
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def json_defaults(o):
+    if isinstance(o, datetime.date):
+        return str(o)
+    else:
+        return o
+
+
+def dumps(o: Any) -> str:
+    return json.dumps(o, default=json_defaults, sort_keys=True)
+
+
+def file_format(path: Path) -> Optional[str]:
+    "Return the format of an existing state file, `sqlite` or `json`"
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        return "sqlite" if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER else "json"
+
+
+class StateBackend:
+    """Base class for storage of the files data.
+
+    The files data is a dictionary with the key `files` which maps each input
+    file to its hash, stat, metadata etc. Other top level keys hold data
+    which isn't per file.
+
+    A backend may leave out the `snippet` of the files when loading and load
+    it on demand with :meth:`load_snippet`, so that the snippets of all the
+    posts aren't held in memory.
+
+    Args:
+        path: Path of the state file
+
+    """
+    name = ""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.migrate = False
+
+    def load(self) -> Dict[str, Any]:
+        fmt = file_format(self.path)
+        if fmt is None:
+            return {"files": {}}
+        if fmt == "sqlite":
+            data = load_sqlite(self.path, snippets=self.name != "sqlite")
+        else:
+            data = load_json(self.path)
+        if fmt != self.name:
+            print_1(f"Will migrate {self.path} from {fmt} to {self.name}")
+            self.migrate = True
+        return data
+
+    def save(self, files_data: Dict[str, Any]):
+        raise NotImplementedError
+
+    def load_snippet(self, fname: str) -> Optional[Dict[str, str]]:
+        "Return the stored snippet of `fname` which wasn't loaded with the files data"
+        return None
+
+
+class JSONState(StateBackend):
+    "Store the files data as a single JSON file which is rewritten on every save"
+    name = "json"
+
+    def save(self, files_data: Dict[str, Any]):
+        atomic_write(self.path, json.dumps(files_data, default=json_defaults).encode("utf-8"))
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    fname TEXT PRIMARY KEY,
+    hash TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    metadata TEXT,
+    "update" INTEGER,
+    snippet TEXT,
+    out_path TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+_columns = ["hash", "stat", "metadata", "update", "snippet", "out_path"]
+
+# NOTE: Snippet of a row whose snippet column wasn't loaded and is kept as is
+STORED = "<stored>"
+
+
+def to_row(fname: str, value: Dict[str, Any]) -> Tuple:
+    stat = value.get("stat") or [None, None]
+    extra = {k: v for k, v in value.items() if k not in _columns}
+    if "snippet" not in value:
+        snippet = STORED
+    elif value["snippet"] is not None:
+        snippet = dumps(value["snippet"])
+    else:
+        snippet = None
+    return (fname, value.get("hash"), stat[0], stat[1],
+            dumps(value["metadata"]) if "metadata" in value else None,
+            int(value["update"]) if "update" in value else None,
+            snippet, value.get("out_path"), dumps(extra) if extra else None)
+
+
+def from_row(row: Tuple) -> Tuple[str, Dict[str, Any]]:
+    fname, hash, size, mtime_ns, metadata, update, snippet, out_path, extra = row
+    value: Dict[str, Any] = json.loads(extra) if extra else {}
+    if hash is not None:
+        value["hash"] = hash
+    if size is not None:
+        value["stat"] = [size, mtime_ns]
+    if metadata is not None:
+        value["metadata"] = json.loads(metadata)
+    if update is not None:
+        value["update"] = bool(update)
+    if snippet is not None:
+        value["snippet"] = json.loads(snippet)
+    if out_path is not None:
+        value["out_path"] = out_path
+    return fname, value
+
+
+def load_json(path: Path) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_sqlite(path: Path, snippets: bool = True) -> Dict[str, Any]:
+    """Load the files data from the SQLite database at `path`.
+
+    If not `snippets`, the `snippet` of the files is left out.
+    """
+    snippet = "snippet" if snippets else "NULL"
+    conn = sqlite3.connect(str(path))
+    try:
+        data: Dict[str, Any] = {k: json.loads(v) for k, v in
+                                conn.execute("SELECT key, value FROM meta")}
+        rows = conn.execute("SELECT fname, hash, size, mtime_ns, metadata, \"update\", " +
+                            f"{snippet}, out_path, extra FROM files ORDER BY fname")
+        data["files"] = dict(map(from_row, rows))
+    finally:
+        conn.close()
+    return data
+
+
+_upsert = """
+INSERT INTO files (fname, hash, size, mtime_ns, metadata, "update", out_path, extra)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (fname) DO UPDATE SET hash = excluded.hash, size = excluded.size,
+    mtime_ns = excluded.mtime_ns, metadata = excluded.metadata,
+    "update" = excluded."update", out_path = excluded.out_path, extra = excluded.extra
+"""
+
+
+class SQLiteState(StateBackend):
+    """Store the files data in an SQLite database with a row per file.
+
+    Only the rows which changed since the data was loaded are written, in a
+    single transaction. An existing JSON state file is migrated to SQLite
+    by writing a new database and renaming it over the old file.
+
+    The snippets aren't loaded with the files data. They're read with
+    :meth:`load_snippet` when needed and a file without a `snippet` keeps
+    the stored one when saved.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.rows: Dict[str, Tuple] = {}
+        self.meta: Dict[str, str] = {}
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def load(self) -> Dict[str, Any]:
+        data = super().load()
+        self.rows = {fname: to_row(fname, value) for fname, value in data["files"].items()}
+        self.meta = {k: dumps(v) for k, v in data.items() if k != "files"}
+        return data
+
+    def load_snippet(self, fname: str) -> Optional[Dict[str, str]]:
+        # NOTE: Snippets are loaded by the listing pages in worker threads
+        with self.lock:
+            if self.conn is None:
+                if self.migrate or file_format(self.path) != "sqlite":
+                    return None
+                self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            row = self.conn.execute("SELECT snippet FROM files WHERE fname = ?",
+                                    (fname,)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def save(self, files_data: Dict[str, Any]):
+        self.close()
+        if self.migrate or file_format(self.path) != "sqlite":
+            self.rows, self.meta = {}, {}
+            path = self.path.with_name(self.path.name + ".tmp")
+            if path.exists():
+                os.remove(path)
+        else:
+            path = self.path
+        rows = {fname: to_row(fname, value) for fname, value in files_data["files"].items()}
+        meta = {k: dumps(v) for k, v in files_data.items() if k != "files"}
+        changed = [row for fname, row in rows.items() if self.rows.get(fname) != row]
+        stored = [row[:6] + row[7:] for row in changed if row[6] == STORED]
+        changed = [row for row in changed if row[6] != STORED]
+        deleted = [(fname,) for fname in self.rows if fname not in rows]
+        changed_meta = [(k, v) for k, v in meta.items() if self.meta.get(k) != v]
+        deleted_meta = [(k,) for k in self.meta if k not in meta]
+        conn = sqlite3.connect(str(path))
+        try:
+            conn.executescript(_schema)
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 changed)
+                conn.executemany(_upsert, stored)
+                conn.executemany("DELETE FROM files WHERE fname = ?", deleted)
+                conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", changed_meta)
+                conn.executemany("DELETE FROM meta WHERE key = ?", deleted_meta)
+        finally:
+            conn.close()
+        if path != self.path:
+            os.replace(path, self.path)
+            self.migrate = False
+        self.rows, self.meta = rows, meta
+
+
+backends = {"sqlite": SQLiteState, "json": JSONState}
+
+
+def get_backend(path: Path, name: str = "sqlite") -> StateBackend:
+    if name not in backends:
+        raise ValueError(f"Unknown state backend {name}. Must be one of {[*backends.keys()]}")
+    return backends[name](path)
@@ -0,0 +1,77 @@
+from typing import Dict, Iterable, List
+import os
+import shutil
+from pathlib import Path
+
+from .util import print_1
+from .output import load_changes, prune_empty_dirs
+
+
+def full_changes(out_dir: Path, exclude: Iterable[str] = (".git",)) -> Dict[str, List[str]]:
+    "Return all the files in `out_dir` as added"
+    added = []
+    for root, dirs, files in os.walk(out_dir):
+        dirs[:] = [d for d in dirs if d not in exclude]
+        for fname in files:
+            added.append(Path(os.path.relpath(os.path.join(root, fname), out_dir)).as_posix())
+    return {"added": sorted(added), "modified": [], "deleted": []}
+
+
+def apply_changes(out_dir: Path, target: Path, changes: Dict[str, List[str]],
+                  dry_run: bool = False) -> int:
+    """Apply `changes` from `out_dir` to `target` directory.
+
+    Added and modified files are copied from `out_dir` and deleted files are
+    removed from `target`. Return the number of files synced.
+    """
+    count = 0
+    for rel_path in [*changes["added"], *changes["modified"]]:
+        src, dest = out_dir.joinpath(rel_path), target.joinpath(rel_path)
+        if not src.exists():
+            print_1(f"{src} doesn't exist. Skipping")
+            continue
+        if dry_run:
+            print_1(f"Not copying {rel_path} as dry run")
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(src, dest)
+        count += 1
+    for rel_path in changes["deleted"]:
+        dest = target.joinpath(rel_path)
+        if not dest.exists():
+            continue
+        if dry_run:
+            print_1(f"Not removing {rel_path} as dry run")
+        else:
+            os.remove(dest)
+            prune_empty_dirs(target, dest)
+        count += 1
+    return count
+
+
+def sync(changes_file: Path, out_dir: Path, target: Path, full: bool = False,
+         keep: bool = False, dry_run: bool = False) -> int:
+    """Sync the pending changes of `out_dir` recorded in `changes_file` to `target`.
+
+    Args:
+        changes_file: File with the pending changes
+        out_dir: The generated output directory
+        target: The directory to sync to
+        full: Sync all the files in `out_dir` instead of just the changes
+        keep: Don't clear the pending changes after syncing
+        dry_run: Only print what would be synced
+
+    """
+    changes = full_changes(out_dir) if full else load_changes(changes_file)
+    if not any(changes.values()):
+        print_1("No changes to sync")
+        return 0
+    print_1(f"Syncing {len(changes['added'])} added, {len(changes['modified'])} modified " +
+            f"and {len(changes['deleted'])} deleted files to {target}")
+    if not dry_run:
+        target.mkdir(parents=True, exist_ok=True)
+    count = apply_changes(out_dir, target, changes, dry_run)
+    if not (keep or dry_run) and changes_file.exists():
+        os.remove(changes_file)
+    print_1(f"Synced {count} files")
+    return count
@@ -0,0 +1,180 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+import re
+from pathlib import Path
+
+
+# NOTE: Matches `$...$` and `${...}` directives, `$$` and `$--` comments.
+#       Directives don't span lines.
+_directive = re.compile(r"\$\$|\$--[^\n]*\n?|\$\{\s*([^}\n]*?)\s*\}|\$([^$\n]+?)\$")
+_name = re.compile(r"^[A-Za-z0-9_.\-]+$")
+_keywords = {"else", "endif", "sep", "endfor"}
+
+
+class TemplateError(Exception):
+    pass
+
+
+Node = Union[str, Tuple]
+
+
+class Template:
+    """A subset of `pandoc templates <https://pandoc.org/MANUAL.html#templates>`_.
+
+    Supported are variables `$var$` and `${var}` with dotted fields,
+    `$if(var)$ ... $elseif(var)$ ... $else$ ... $endif$`,
+    `$for(var)$ ... $sep$ ... $endfor$` (the variable and `$it$` refer to
+    the current item inside the loop), partials `$name()$`, literal `$$`
+    and `$--` comments. Pipes are ignored. Like pandoc, anything else between
+    `$` raises :class:`TemplateError`, so a literal `$` must be written as `$$`.
+
+    The template is parsed once and can be rendered any number of times.
+
+    Args:
+        text: The template text
+        templates_dir: Directory to search for partials
+
+    """
+    def __init__(self, text: str, templates_dir: Optional[Path] = None, suffix: str = ""):
+        self.templates_dir = templates_dir
+        self.suffix = suffix
+        self.nodes = self._parse(self._tokenize(text))
+
+    @classmethod
+    def from_file(cls, path: Path) -> "Template":
+        with open(path) as f:
+            return cls(f.read(), path.parent, path.suffix)
+
+    def _tokenize(self, text: str) -> List[Node]:
+        tokens: List[Node] = []
+        pos = 0
+        for m in _directive.finditer(text):
+            tokens.append(text[pos:m.start()])
+            pos = m.end()
+            if m.group(0) == "$$":
+                tokens.append("$")
+            elif m.group(0).startswith("$--"):
+                continue
+            else:
+                directive = (m.group(1) if m.group(1) is not None else m.group(2)).strip()
+                if directive.endswith("()") and _name.match(directive[:-2]):
+                    tokens.extend(self._partial(directive[:-2]))
+                else:
+                    tokens.append(("directive", directive))
+        tokens.append(text[pos:])
+        return [t for t in tokens if t != ""]
+
+    def _partial(self, name: str) -> List[Node]:
+        if self.templates_dir is None:
+            raise TemplateError(f"No templates dir to look for partial {name}")
+        path = self.templates_dir.joinpath(name + self.suffix)
+        if not path.exists():
+            path = self.templates_dir.joinpath(name)
+        with open(path) as f:
+            return self._tokenize(f.read().rstrip("\n"))
+
+    def _parse(self, tokens: List[Node], end: Tuple[str, ...] = ()) -> List[Node]:
+        nodes: List[Node] = []
+        while tokens:
+            token = tokens.pop(0)
+            if isinstance(token, str):
+                nodes.append(token)
+                continue
+            directive = token[1]
+            if directive in end or any(directive.startswith(e + "(") for e in end):
+                tokens.insert(0, token)
+                return nodes
+            if directive.startswith("if("):
+                branches = []
+                cond: Optional[str] = self._variable(directive, directive[3:-1])
+                while True:
+                    body = self._parse(tokens, ("elseif", "else", "endif"))
+                    branches.append((cond, body))
+                    if not tokens:
+                        raise TemplateError("Unterminated $if$")
+                    directive = tokens.pop(0)[1]
+                    if directive == "endif":
+                        break
+                    cond = self._variable(directive, directive[7:-1])\
+                        if directive.startswith("elseif(") else None
+                nodes.append(("if", branches))
+            elif directive.startswith("for("):
+                var = self._variable(directive, directive[4:-1])
+                body = self._parse(tokens, ("sep", "endfor"))
+                sep: List[Node] = []
+                if tokens and tokens[0][1] == "sep":
+                    tokens.pop(0)
+                    sep = self._parse(tokens, ("endfor",))
+                if not tokens:
+                    raise TemplateError("Unterminated $for$")
+                tokens.pop(0)
+                nodes.append(("for", var, body, sep))
+            else:
+                nodes.append(("var", self._variable(directive, directive.split("/")[0])))
+        if end:
+            raise TemplateError(f"Expected one of {end}")
+        return nodes
+
+    @staticmethod
+    def _variable(directive: str, name: str) -> str:
+        "Return variable `name` of `directive` or raise if it isn't valid"
+        name = name.strip()
+        if not _name.match(name) or name in _keywords:
+            raise TemplateError(f"Unexpected ${directive}$ in template. " +
+                                "Use $$ for a literal $")
+        return name
+
+    @staticmethod
+    def lookup(context: Dict[str, Any], name: str) -> Any:
+        value: Any = context
+        for part in name.split("."):
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+            else:
+                return None
+        return value
+
+    @staticmethod
+    def truthy(value: Any) -> bool:
+        if isinstance(value, (list, dict)):
+            return bool(value)
+        return value is not None and value is not False and value != ""
+
+    @classmethod
+    def stringify(cls, value: Any) -> str:
+        if value is None or value is False:
+            return ""
+        if value is True:
+            return "true"
+        if isinstance(value, list):
+            return "".join(map(cls.stringify, value))
+        if isinstance(value, dict):
+            return "true"
+        return str(value)
+
+    def _render(self, nodes: List[Node], context: Dict[str, Any], out: List[str]):
+        for node in nodes:
+            if isinstance(node, str):
+                out.append(node)
+            elif node[0] == "var":
+                out.append(self.stringify(self.lookup(context, node[1])))
+            elif node[0] == "if":
+                for cond, body in node[1]:
+                    if cond is None or self.truthy(self.lookup(context, cond)):
+                        self._render(body, context, out)
+                        break
+            elif node[0] == "for":
+                _, var, body, sep = node
+                value = self.lookup(context, var)
+                items = value if isinstance(value, list) else\
+                    ([value] if self.truthy(value) else [])
+                for i, item in enumerate(items):
+                    if i:
+                        self._render(sep, context, out)
+                    # NOTE: Only top level variables can be overridden in the loop
+                    self._render(body, {**context, var.split(".")[0]: item, "it": item}
+                                 if "." not in var else {**context, "it": item}, out)
+
+    def render(self, context: Dict[str, Any]) -> str:
+        out: List[str] = []
+        self._render(self.nodes, context, out)
+        return "".join(out)
@@ -1,21 +1,47 @@
 from typing import List, Union, Dict, Tuple
 import re
 import os
+import sys
 import yaml
+import logging
 from pathlib import Path
 from configparser import ConfigParser
 from functools import partial
 from subprocess import Popen, PIPE
-import sass
 
 
-def print_w_prefix(msg: str, prefix: str = "") -> None:
-    print(f"{prefix}{msg}")
+class BuildError(Exception):
+    "Error in generating an output file. The build continues with other files."
+
+
+logger = logging.getLogger("bloggen")
+
+
+def print_w_prefix(msg: str, prefix: str = "", level: int = logging.INFO) -> None:
+    if logger.isEnabledFor(level):
+        logger.log(level, f"{prefix}{msg}")
 
 
 print_ = print_w_prefix
 print_1 = partial(print_w_prefix, prefix="\t")
-print_2 = partial(print_w_prefix, prefix="\t\t")
+print_2 = partial(print_w_prefix, prefix="\t\t", level=logging.DEBUG)
+warn_ = partial(print_w_prefix, level=logging.WARNING)
+warn_1 = partial(print_w_prefix, prefix="\t", level=logging.WARNING)
+
+
+def setup_logging(verbosity: int = 0) -> None:
+    """Print the messages of bloggen to stdout according to `verbosity`.
+
+    Below 0 only warnings and errors are printed, at 0 the progress messages
+    too and above 0 the detailed messages of :func:`print_2` as well.
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.WARNING if verbosity < 0 else
+                    logging.INFO if verbosity == 0 else logging.DEBUG)
 
 
 def extract_metadata(filename: str) -> Dict:
@@ -74,21 +100,21 @@ def update_config_file(config: ConfigParser, keys: str, values: str,
 
 
 def compile_sass(assets_dir: Path) -> None:
-    cur_dir = Path(os.curdir).absolute()
+    import sass
     css_dir = assets_dir.joinpath("css").absolute()
     scss_dir = assets_dir.joinpath("css", "scss").absolute()
     if scss_dir.exists() and scss_dir.is_dir():
         in_file = scss_dir.joinpath("main.scss")
         if in_file.exists():
-            print(f"Compiling {in_file}")
+            print_(f"Compiling {in_file}")
             out_file = css_dir.joinpath("main.css")
-            os.chdir(scss_dir)
+            # NOTE: Imports are resolved with include_paths instead of changing
+            #       the working directory, as this runs alongside other tasks
             with open(in_file) as f:
-                temp: str = sass.compile(string=f.read())
+                temp: str = sass.compile(string=f.read(), include_paths=[str(scss_dir)])
             with open(out_file, "w") as f:
                 f.write(temp)
         else:
-            print(f"main.scss not in {scss_dir}")
+            warn_(f"main.scss not in {scss_dir}")
     else:
-        print(f"No Sass to compile")
-    os.chdir(cur_dir)
+        print_(f"No Sass to compile")
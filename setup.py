@@ -45,6 +45,10 @@ setup(
         "PyYAML==5.4.1",
         "beautifulsoup4==4.9.3",
         "common-pyutil>=0.3.0"],
+    extras_require={
+        "images": ["Pillow"],
+        "markdown": ["markdown-it-py"],
+        "related": ["numpy", "scipy"]},
     entry_points={
         'console_scripts': [
             'bloggen = bloggen.__main__:main',
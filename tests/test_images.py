@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from bloggen import images
+
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path.joinpath("pic.png")
+    Image.new("RGB", (300, 200), "red").save(path)
+    return path
+
+
+def test_derivative_name():
+    assert images.derivative_name("post/pic.png", 480, "webp") == "post/pic-480w.webp"
+
+
+def test_image_widths_smaller_than_image(image):
+    assert images.image_widths(image, [100, 250, 480]) == [100, 250, 300]
+
+
+def test_make_derivatives(image, tmp_path):
+    cache_dir = str(tmp_path.joinpath("cache"))
+    result = images.make_derivatives(str(image), cache_dir, [100, 480], "webp", 80)
+    assert sorted(result) == [100, 300]
+    for width, path in result.items():
+        with Image.open(path) as im:
+            assert im.format == "WEBP"
+            assert im.size == (width, round(200 * width / 300))
+
+
+def test_make_derivatives_cached(image, tmp_path):
+    cache_dir = str(tmp_path.joinpath("cache"))
+    first = images.make_derivatives(str(image), cache_dir, [100], "webp", 80)
+    mtimes = {k: os.stat(v).st_mtime_ns for k, v in first.items()}
+    second = images.make_derivatives(str(image), cache_dir, [100], "webp", 80)
+    assert second == first
+    assert {k: os.stat(v).st_mtime_ns for k, v in second.items()} == mtimes
+
+
+def test_make_derivatives_changed_image(image, tmp_path):
+    cache_dir = str(tmp_path.joinpath("cache"))
+    first = images.make_derivatives(str(image), cache_dir, [100], "webp", 80)
+    Image.new("RGB", (200, 100), "blue").save(image)
+    second = images.make_derivatives(str(image), cache_dir, [100], "webp", 80)
+    assert sorted(second) == [100, 200]
+    assert second[100] != first[100]
+
+
+def test_add_srcsets():
+    page = '<p><img src="post/pic.png" alt="x"> <img src="other.png"></p>'
+    result = images.add_srcsets(page, {"post/pic.png": [100, 300]}, "webp")
+    assert result == ('<p><picture><source type="image/webp" ' +
+                      'srcset="post/pic-100w.webp 100w, post/pic-300w.webp 300w" ' +
+                      'sizes="100vw"><img src="post/pic.png" alt="x"></picture> ' +
+                      '<img src="other.png"></p>')
@@ -0,0 +1,18 @@
+from bloggen.metrics import append_history, load_history
+
+
+def test_append_history(tmp_path):
+    path = tmp_path.joinpath(".bloggen", "history.jsonl")
+    append_history(path, {"time": 1})
+    append_history(path, {"time": 2})
+    assert load_history(path) == [{"time": 1}, {"time": 2}]
+
+
+def test_append_history_drops_old_records(tmp_path):
+    path = tmp_path.joinpath("history.jsonl")
+    for i in range(100):
+        append_history(path, {"time": i}, max_size=200)
+        assert path.stat().st_size <= 200
+    history = load_history(path)
+    assert history[-1] == {"time": 99}
+    assert [x["time"] for x in history] == [*range(100 - len(history), 100)]
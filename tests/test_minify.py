@@ -0,0 +1,46 @@
+from bloggen.minify import minify_css, minify_html, minify_js
+
+
+def test_minify_css():
+    css = "a :hover {\n  color : red;\n  margin: 0 ;\n}\n/* comment */\nb > i { top: 0 }\n"
+    assert minify_css(css) == "a :hover{color :red;margin:0}b>i{top:0}"
+
+
+def test_minify_css_keeps_strings():
+    css = 'p::before { content: "a ,  b" ; }\nq::after { content: \'/* x */\' }'
+    assert minify_css(css) == 'p::before{content:"a ,  b"}q::after{content:\'/* x */\'}'
+
+
+def test_minify_js():
+    js = "// header\nfunction f(a) {\n    // comment\n\n    return a;   \n}\n"
+    assert minify_js(js) == "function f(a) {\nreturn a;\n}"
+
+
+def test_minify_js_keeps_template_literals():
+    js = "const t = `one\n  // not a comment\n\n    ${a + `b`}\n`;\n  x();\n"
+    assert minify_js(js) == "const t = `one\n  // not a comment\n\n    ${a + `b`}\n`;\nx();"
+
+
+def test_minify_js_keeps_continued_strings():
+    js = 'const s = "multi \\\n   // line";\n  // comment\n'
+    assert minify_js(js) == 'const s = "multi \\\n   // line";'
+
+
+def test_minify_js_regex_and_division():
+    js = "  var r = /['`]/g;\n  x = a / 2 / `${b}`;\n    // comment\n"
+    assert minify_js(js) == "var r = /['`]/g;\nx = a / 2 / `${b}`;"
+
+
+def test_minify_js_block_comments():
+    js = "/* start\n   // end */\n  f();\n"
+    assert minify_js(js) == "/* start\n// end */\nf();"
+
+
+def test_minify_html_keeps_protected_blocks():
+    html = "<p>  a\n\n  b </p>\n<pre>  x\n  y</pre>  <!-- c --> <style> a { color: red; } </style>"
+    assert minify_html(html) == "<p> a\nb </p>\n<pre>  x\n  y</pre> <style>a{color:red}</style>"
+
+
+def test_minify_html_parts_keep_whitespace_at_ends():
+    assert minify_html("  <li>a</li>\n", strip=False) == " <li>a</li>\n"
+    assert minify_html("  <li>a</li>\n") == "<li>a</li>"
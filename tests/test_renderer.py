@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from bloggen import renderer
+from bloggen.template import Template
+
+
+@pytest.fixture
+def post(tmp_path):
+    def post(body, front="title: Post"):
+        path = tmp_path.joinpath("post.md")
+        path.write_text(f"---\n{front}\n---\n{body}\n")
+        return path
+    return post
+
+
+@pytest.mark.parametrize("body", ["Hello, world -- with `code` and a [link](a.html)",
+                                  "| a | b |\n|---|---|\n| 1 | 2 |",
+                                  "~~gone~~ and \"quotes\"", "---\n\nafter a rule"])
+def test_doesnt_need_pandoc(post, body):
+    assert not renderer.needs_pandoc(post(body), {"title": "Post"})
+
+
+@pytest.mark.parametrize("body", ["Inline $x^2$ math", "$$\nx\n$$",
+                                  "Note[^1]\n\n[^1]: The note", "Inline^[note]",
+                                  "# Heading {#id .class}", "```{.python}\nx\n```",
+                                  "Term\n:   Definition", "a   b\n---  ---\n1   2",
+                                  "+---+---+\n| a | b |\n+---+---+", "::: warning\nx\n:::",
+                                  "H~2~O", "x^2^", "![fig](a.png){width=50%}"])
+def test_needs_pandoc(post, body):
+    assert renderer.needs_pandoc(post(body), {"title": "Post"})
+
+
+def test_needs_pandoc_metadata(post):
+    path = post("Plain")
+    assert renderer.needs_pandoc(path, {"bibliography": "refs.bib"})
+    assert renderer.needs_pandoc(path, {"renderer": "pandoc"})
+    assert not renderer.needs_pandoc(post("$x$"), {"renderer": "markdown"})
+
+
+def test_parse_fragment():
+    output = ('<!--BLOGGEN:META-->\n{"title": "T"}\n<!--BLOGGEN:TOC-->\n<ul></ul>\n' +
+              "<!--BLOGGEN:HIGHLIGHTING-CSS-->\ncode{}\n<!--BLOGGEN:MATH-->\n\n" +
+              "<!--BLOGGEN:HEADER-INCLUDES-->\n\n<!--BLOGGEN:BODY-->\n" +
+              "<p>Has <!--BLOGGEN:TOC--> in it</p>\n")
+    assert renderer.parse_fragment(output) == {
+        "meta": {"title": "T"}, "toc": "<ul></ul>",
+        "vars": {"highlighting-css": "code{}", "math": "", "header-includes": ""},
+        "body": "<p>Has <!--BLOGGEN:TOC--> in it</p>"}
+
+
+def test_fill_template(tmp_path):
+    template = Template("$pagetitle$|$if(toc)$$toc$$endif$|$highlighting-css$|$body$",
+                        tmp_path)
+    fragment = {"meta": {"title": "<em>T</em>"}, "toc": "<ul></ul>", "body": "<p>x</p>",
+                "vars": {"highlighting-css": "code{}", "math": ""}}
+    assert renderer.fill_template(template, fragment, tmp_path) == "T||code{}|<p>x</p>"
+    assert renderer.fill_template(template, fragment, tmp_path, toc=True) ==\
+        "T|<ul></ul>|code{}|<p>x</p>"
+
+
+def test_markdown_renderer(post, tmp_path):
+    pytest.importorskip("markdown_it")
+    md = renderer.MarkdownRenderer(tmp_path)
+    path = post("# A heading\n\nSaid \"hi\" -- ~~no~~... (c)\n\n## A heading",
+                "title: \"A\" -- post")
+    fragment = asyncio.run(md.render_fragment(path, {"title": "\"A\" -- post"}))
+    assert fragment["meta"] == {"title": "“A” – post"}
+    assert fragment["body"] == ('<h1 id="a-heading">A heading</h1>\n' +
+                                "<p>Said “hi” – <del>no</del>… (c)</p>\n" +
+                                '<h2 id="a-heading-1">A heading</h2>\n')
+    assert 'href="#a-heading-1"' in fragment["toc"]
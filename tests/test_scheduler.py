@@ -0,0 +1,66 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from bloggen.scheduler import Scheduler
+
+
+def test_inputs_and_dependencies():
+    done = []
+    scheduler = Scheduler(4)
+    scheduler.add("a", lambda: done.append("a") or 1)
+    scheduler.add("b", lambda: done.append("b") or 2, ["a"])
+
+    async def add(x, y):
+        done.append("c")
+        return x + y
+    scheduler.add("c", add, [], ["a", "b"])
+    assert scheduler.run() == {"a": 1, "b": 2, "c": 3}
+    assert done == ["a", "b", "c"]
+
+
+def test_unknown_and_duplicate_tasks():
+    scheduler = Scheduler(1)
+    scheduler.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        scheduler.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        scheduler.add("b", lambda: None, ["c"])
+
+
+def test_functions_run_in_threads():
+    threads = set()
+    scheduler = Scheduler(2)
+    for name in "ab":
+        scheduler.add(name, lambda: threads.add(threading.get_ident()) or time.sleep(0.05))
+    scheduler.run()
+    assert threading.get_ident() not in threads
+
+
+def test_jobs_limit():
+    running = []
+    peak = []
+
+    async def task():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+    scheduler = Scheduler(2)
+    for i in range(6):
+        scheduler.add(str(i), task)
+    scheduler.run()
+    assert max(peak) == 2
+
+
+def test_failure_fails_dependents():
+    ran = []
+    scheduler = Scheduler(2)
+    scheduler.add("a", lambda: 1 / 0)
+    scheduler.add("b", lambda: ran.append("b"), ["a"])
+    scheduler.add("c", lambda: ran.append("c"))
+    with pytest.raises(ZeroDivisionError):
+        scheduler.run()
+    assert ran == ["c"]
@@ -0,0 +1,121 @@
+import json
+import sqlite3
+
+import pytest
+
+from bloggen import state
+
+
+def files_data():
+    return {"files": {name: {"hash": name * 3, "stat": [10, 100], "update": False,
+                             "metadata": {"title": name.upper(), "category": "research",
+                                          "date": "2020-01-01"},
+                             "out_path": f"research/{name}.html",
+                             "deps": ["output", "renderer"]}
+                      for name in ["a.md", "b.md", "c.md"]},
+            "fingerprints": {"inputs": {"csl": "abc"}, "stats": {}}}
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def backend(request, tmp_path):
+    return state.get_backend(tmp_path.joinpath(".files_data"), request.param)
+
+
+def test_load_missing(backend):
+    assert backend.load() == {"files": {}}
+
+
+def test_save_and_load(backend):
+    data = files_data()
+    backend.save(data)
+    assert state.file_format(backend.path) == backend.name
+    assert state.get_backend(backend.path, backend.name).load() == data
+
+
+def test_load_order_stable_after_change(backend):
+    data = files_data()
+    backend.save(data)
+    data = backend.load()
+    data["files"]["a.md"]["hash"] = "changed"
+    backend.save(data)
+    loaded = state.get_backend(backend.path, backend.name).load()
+    assert [*loaded["files"]] == ["a.md", "b.md", "c.md"]
+    assert loaded["files"]["a.md"]["hash"] == "changed"
+
+
+def test_sqlite_writes_only_changed_rows(tmp_path):
+    path = tmp_path.joinpath(".files_data")
+    backend = state.SQLiteState(path)
+    backend.save(files_data())
+    data = backend.load()
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("UPDATE files SET out_path = 'marker' WHERE fname = 'b.md'")
+    conn.close()
+    data["files"]["a.md"]["update"] = True
+    data["files"].pop("c.md")
+    backend.save(data)
+    loaded = state.SQLiteState(path).load()
+    assert loaded["files"]["a.md"]["update"] is True
+    assert loaded["files"]["b.md"]["out_path"] == "marker"
+    assert "c.md" not in loaded["files"]
+
+
+def test_migrate_json_to_sqlite(tmp_path):
+    path = tmp_path.joinpath(".files_data")
+    data = files_data()
+    path.write_text(json.dumps(data))
+    backend = state.SQLiteState(path)
+    assert backend.load() == data
+    assert backend.migrate
+    backend.save(data)
+    assert state.file_format(path) == "sqlite"
+    assert not path.with_name(path.name + ".tmp").exists()
+    assert state.SQLiteState(path).load() == data
+
+
+def test_migrate_sqlite_to_json(tmp_path):
+    path = tmp_path.joinpath(".files_data")
+    data = files_data()
+    state.SQLiteState(path).save(data)
+    backend = state.JSONState(path)
+    assert backend.load() == data
+    backend.save(data)
+    assert state.file_format(path) == "json"
+    assert state.JSONState(path).load() == data
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        state.get_backend(tmp_path.joinpath(".files_data"), "pickle")
+
+
+def test_sqlite_loads_snippets_on_demand(tmp_path):
+    path = tmp_path.joinpath(".files_data")
+    data = files_data()
+    data["files"]["a.md"]["snippet"] = {"heading": "A", "text": "Text of a"}
+    data["files"]["b.md"]["snippet"] = {"heading": "B", "text": "Text of b"}
+    state.SQLiteState(path).save(data)
+    backend = state.SQLiteState(path)
+    loaded = backend.load()
+    assert all("snippet" not in value for value in loaded["files"].values())
+    assert backend.load_snippet("a.md") == {"heading": "A", "text": "Text of a"}
+    assert backend.load_snippet("c.md") is None
+    loaded["files"]["a.md"]["update"] = True
+    loaded["files"]["b.md"]["snippet"] = None
+    backend.save(loaded)
+    backend = state.SQLiteState(path)
+    loaded = backend.load()
+    assert loaded["files"]["a.md"]["update"] is True
+    assert backend.load_snippet("a.md") == {"heading": "A", "text": "Text of a"}
+    assert backend.load_snippet("b.md") is None
+
+
+def test_migrate_sqlite_to_json_keeps_snippets(tmp_path):
+    path = tmp_path.joinpath(".files_data")
+    data = files_data()
+    data["files"]["a.md"]["snippet"] = {"heading": "A", "text": "Text of a"}
+    state.SQLiteState(path).save(data)
+    backend = state.JSONState(path)
+    backend.save(backend.load())
+    assert state.JSONState(path).load() == data
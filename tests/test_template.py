@@ -0,0 +1,61 @@
+import pytest
+
+from bloggen.template import Template, TemplateError
+
+
+def render(text, context, templates_dir=None):
+    return Template(text, templates_dir).render(context)
+
+
+def test_variables():
+    context = {"title": "T", "meta": {"author": {"name": "A"}}, "draft": False,
+               "toc": True, "list": ["a", "b"]}
+    assert render("$title$|${ title }|$meta.author.name$|$missing$|$meta.none.x$",
+                  context) == "T|T|A||"
+    assert render("$draft$|$toc$|$list$|$meta$", context) == "|true|ab|true"
+    assert render("$title/uppercase$", context) == "T"
+
+
+@pytest.mark.parametrize("context,expected", [({"a": 1}, "A"), ({"b": "x"}, "B"),
+                                              ({"a": ""}, "C"), ({"a": []}, "C"),
+                                              ({"a": False, "b": {}}, "C")])
+def test_if(context, expected):
+    assert render("$if(a)$A$elseif(b)$B$else$C$endif$", context) == expected
+
+
+def test_for():
+    context = {"authors": [{"name": "A"}, {"name": "B"}], "tags": ["x", "y", "z"],
+               "meta": {"items": [1, 2]}, "one": "only"}
+    assert render("$for(authors)$$authors.name$$sep$, $endfor$", context) == "A, B"
+    assert render("$for(tags)$[$it$]$endfor$", context) == "[x][y][z]"
+    assert render("$for(meta.items)$$it$$sep$+$endfor$", context) == "1+2"
+    assert render("$for(one)$$one$$endfor$|$for(none)$x$endfor$", context) == "only|"
+
+
+def test_partials(tmp_path):
+    tmp_path.joinpath("header.html").write_text("<h1>$title$</h1>\n")
+    tmp_path.joinpath("footer").write_text("$if(author)$by $author$$endif$\n")
+    path = tmp_path.joinpath("page.html")
+    path.write_text("$header()$<p>$body$</p>$footer()$")
+    template = Template.from_file(path)
+    assert template.render({"title": "T", "body": "B", "author": "A"}) ==\
+        "<h1>T</h1><p>B</p>by A"
+    with pytest.raises(TemplateError):
+        Template("$header()$")
+
+
+def test_literal_dollar_and_comments():
+    assert render("Costs $$5 $-- a comment\nand $$$price$", {"price": 3}) == "Costs $5 and $3"
+
+
+@pytest.mark.parametrize("text", ["Costs $5 and $6", "$if(a)$x", "$for(a)$x",
+                                  "$endif$", "$if(a b)$x$endif$", "$else$"])
+def test_errors(text):
+    with pytest.raises(TemplateError):
+        Template(text)
+
+
+def test_render_again():
+    template = Template("$if(a)$$a$$endif$")
+    assert template.render({"a": "x"}) == "x"
+    assert template.render({}) == ""